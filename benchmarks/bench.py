@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+##############################
+Automarking Pipeline Benchmark
+##############################
+
+Benchmarks each phase of the marking pipeline on a synthetic cohort generated by
+:mod:`cohort`. For each phase the minimum and median run time and the peak memory
+allocated by Python are reported. The phases are:
+
+* ``index`` -- indexing the gradebook by student number
+* ``extract`` -- loading all submissions from the gradebook
+* ``match`` -- classifying all archive filenames with the :class:`~automarking.core.SpecMatcher`
+* ``match-spec`` -- classifying all archive filenames with :meth:`~automarking.core.SubmissionSpec.matches`
+* ``mark`` -- iterating over all parts with :func:`~automarking.mark`
+* ``extract_code`` -- extracting the student code from all files
+* ``write-back`` -- writing the results back to the gradecolumn
+
+The automarking package must be installed to run the benchmarks. Run
+``python benchmarks/bench.py --help`` for the available options.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import argparse
+import os
+import shutil
+import statistics
+import tarfile
+import tempfile
+import time
+import tracemalloc
+
+from zipfile import ZipFile
+
+from automarking import mark, BlackboardDataSource
+from automarking.core import index_gradebook, SpecMatcher
+from automarking.tests import extract_code
+
+import cohort
+
+
+class PreparedSource(object):
+    """Data source that returns already loaded submissions, so that :func:`~automarking.mark`
+    can be benchmarked without loading the submissions."""
+
+    def __init__(self, submissions):
+        self.submissions = submissions
+
+    def __enter__(self):
+        return self.submissions
+
+    def __exit__(self, type_, value, traceback):
+        pass
+
+
+def measure(setup, run, repeat):
+    """Measure the ``run`` function ``repeat`` times, calling ``setup`` before each run
+    and passing its result to ``run``. The peak memory is measured in a separate run,
+    as tracing the allocations slows down the run.
+
+    :return: The run times in seconds and the peak memory in bytes
+    :rtype: ``tuple``
+    """
+    times = []
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+    state = setup()
+    tracemalloc.start()
+    run(state)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (times, peak)
+
+
+def archive_names(gradebook):
+    """List the filenames in all ZIP and tar submissions in the ``gradebook``."""
+    names = []
+    with ZipFile(gradebook) as in_f:
+        for filename in in_f.namelist():
+            if filename.endswith('.zip'):
+                with ZipFile(in_f.open(filename)) as archive:
+                    names.extend(archive.namelist())
+            elif filename.endswith('.tar.gz') or filename.endswith('.tar.bz2'):
+                with tarfile.open(fileobj=in_f.open(filename), mode='r|*') as archive:
+                    names.extend(member.name for member in archive)
+    return names
+
+
+def index(gradebook):
+    with ZipFile(gradebook) as in_f:
+        return index_gradebook(in_f)
+
+
+def load(gradebook, gradecolumn, specs):
+    """Load all submissions from the ``gradebook``."""
+    source = BlackboardDataSource(gradebook, gradecolumn, specs)
+    return source.__enter__()
+
+
+def mark_all(submissions):
+    for part, data in mark(PreparedSource(submissions)):
+        if data is not None:
+            part.score = part.score + 1
+            part.feedback.append(data[0])
+
+
+def extract_all(submissions):
+    for submission in submissions:
+        for part in submission.parts:
+            data = part.data if isinstance(part.data, list) else [part.data] if part.data is not None else []
+            for _, filedata in data:
+                filedata.seek(0)
+                extract_code(filedata)
+
+
+def write_back(state):
+    source, submissions = state
+    source._write_gradecolumn(submissions)
+
+
+def run_benchmarks(gradebook, gradecolumn, specs, repeat):
+    """Run the benchmarks for all phases.
+
+    :return: The phase names, run times, and peak memory
+    :rtype: ``list`` of ``tuple``
+    """
+    matcher = SpecMatcher(specs)
+    names = archive_names(gradebook)
+
+    def marked_submissions():
+        submissions = load(gradebook, gradecolumn, specs)
+        mark_all(submissions)
+        return dict((submission.studentnr, submission) for submission in submissions)
+
+    target = os.path.join(os.path.dirname(gradecolumn), 'gradecolumn-write-back.csv')
+
+    def writable_gradecolumn():
+        shutil.copy(gradecolumn, target)
+        return (BlackboardDataSource(gradebook, target, specs), marked)
+
+    marked = marked_submissions()
+    phases = [('index', lambda: gradebook, index),
+              ('extract', lambda: None, lambda _: load(gradebook, gradecolumn, specs)),
+              ('match', lambda: names, lambda names: [matcher.classify(name) for name in names]),
+              ('match-spec', lambda: names, lambda names: [[spec.matches(name) for spec in specs] for name in names]),
+              ('mark', lambda: load(gradebook, gradecolumn, specs), mark_all),
+              ('extract_code', lambda: load(gradebook, gradecolumn, specs), extract_all),
+              ('write-back', writable_gradecolumn, write_back)]
+    results = []
+    for name, setup, run in phases:
+        times, peak = measure(setup, run, repeat)
+        results.append((name, times, peak))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the automarking pipeline on a synthetic cohort')
+    parser.add_argument('--directory', help='Directory to generate the cohort in. Defaults to a temporary directory')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per phase')
+    cohort.add_arguments(parser)
+    args = parser.parse_args()
+    directory = args.directory if args.directory else tempfile.mkdtemp()
+    gradebook, gradecolumn, specs = cohort.generate(directory, students=args.students, mix=args.mix,
+                                                    files=args.files, file_size=args.file_size,
+                                                    spec_count=args.specs, feedback_size=args.feedback_size,
+                                                    seed=args.seed)
+    print('%-14s %10s %10s %12s' % ('Phase', 'Min (s)', 'Median (s)', 'Peak (MiB)'))
+    for name, times, peak in run_benchmarks(gradebook, gradecolumn, specs, args.repeat):
+        print('%-14s %10.4f %10.4f %12.2f' % (name, min(times), statistics.median(times), peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
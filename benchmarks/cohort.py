@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+#####################################
+Synthetic Blackboard Cohort Generator
+#####################################
+
+Generates a synthetic Blackboard gradebook ZIP and matching gradecolumn CSV for
+benchmarking. The cohort size, the mix of submission types, the number and size of
+the files in each submission, and the number of specs can all be configured.
+
+RAR submissions can only be generated if the ``rar`` command is installed. Otherwise
+they are generated as ZIP submissions instead.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+from csv import writer
+from io import BytesIO
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from automarking import SubmissionSpec
+
+DEFAULT_MIX = 'tar.gz=3,tar.bz2=1,zip=4,rar=1,missing=1'
+HEADER = ['Last Name', 'First Name', 'Username', 'Student ID', 'Assignment [Total Pts: 100] |1', 'Grading Notes',
+          'Notes Format', 'Feedback to Learner', 'Feedback Format']
+
+
+def make_specs(count):
+    """Create ``count`` :class:`~automarking.core.SubmissionSpec`\\ s, each of which matches one of
+    the file extensions used in the generated submissions."""
+    return [SubmissionSpec('spec%i' % idx, 'Part %i' % (idx + 1), [r'\.ext%i$' % idx, r'^EXT%i_' % idx])
+            for idx in range(count)]
+
+
+def parse_mix(mix):
+    """Parse a submission type mix of the form ``type=weight,type=weight``."""
+    weights = {}
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def make_file(rnd, size):
+    """Generate a source file of about ``size`` bytes with a student code section."""
+    lines = ['// Generated file']
+    length = len(lines[0])
+    marker = rnd.randint(1, 10)
+    while length < size:
+        if len(lines) == marker:
+            lines.append('// StartStudentCode')
+        elif len(lines) == marker * 2 + 1:
+            lines.append('// EndStudentCode')
+        else:
+            lines.append('int value%i = %i;' % (len(lines), rnd.randint(0, 1000000)))
+        length = length + len(lines[-1]) + 1
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def make_archive(rnd, kind, files, file_size, spec_count):
+    """Generate a submission archive of the ``kind`` containing ``files`` files."""
+    members = []
+    for idx in range(files):
+        name = 'submission/src/file%i.ext%i' % (idx, idx % max(spec_count, 1))
+        if idx % 5 == 4:
+            name = 'submission/docs/notes%i.txt' % idx
+        members.append((name, make_file(rnd, file_size)))
+    buffer = BytesIO()
+    if kind in ('tar.gz', 'tar.bz2'):
+        with tarfile.open(fileobj=buffer, mode='w:%s' % kind[4:]) as out_f:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                out_f.addfile(info, BytesIO(data))
+    elif kind == 'zip':
+        with ZipFile(buffer, 'w', ZIP_DEFLATED) as out_f:
+            for name, data in members:
+                out_f.writestr(name, data)
+    elif kind == 'rar':
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name, data in members:
+                os.makedirs(os.path.dirname(os.path.join(tmpdir, name)), exist_ok=True)
+                with open(os.path.join(tmpdir, name), 'wb') as out_f:
+                    out_f.write(data)
+            subprocess.run(['rar', 'a', '-r', '-idq', 'submission.rar', 'submission'], cwd=tmpdir, check=True)
+            with open(os.path.join(tmpdir, 'submission.rar'), 'rb') as in_f:
+                buffer.write(in_f.read())
+    return buffer.getvalue()
+
+
+def generate(directory, students=600, mix=DEFAULT_MIX, files=5, file_size=4096, spec_count=3, feedback_size=0,
+             seed=0):
+    """Generate a synthetic cohort in the ``directory``.
+
+    :return: The gradebook filename, the gradecolumn filename, and the
+             :class:`~automarking.core.SubmissionSpec`\\ s
+    :rtype: ``tuple``
+    """
+    rnd = random.Random(seed)
+    weights = parse_mix(mix)
+    if 'rar' in weights and shutil.which('rar') is None:
+        sys.stderr.write('The rar command is not installed, generating ZIP submissions instead of RAR\n')
+        weights['zip'] = weights.get('zip', 0) + weights.pop('rar')
+    kinds = list(weights.keys())
+    os.makedirs(directory, exist_ok=True)
+    gradebook = os.path.join(directory, 'gradebook.zip')
+    gradecolumn = os.path.join(directory, 'gradecolumn.csv')
+    studentnrs = ['%08i' % (10000000 + idx * 7919) for idx in range(students)]
+    with ZipFile(gradebook, 'w', ZIP_DEFLATED) as out_f:
+        for studentnr in studentnrs:
+            kind = rnd.choices(kinds, [weights[kind] for kind in kinds])[0]
+            prefix = 'Assignment_%s_attempt_2016-02-06-19-40-22' % studentnr
+            out_f.writestr('%s.txt' % prefix, 'Name: Student %s\n' % studentnr)
+            if kind != 'missing':
+                out_f.writestr('%s_submission.%s' % (prefix, kind),
+                               make_archive(rnd, kind, files, file_size, spec_count))
+    with open(gradecolumn, 'w', encoding='utf-8-sig') as out_f:
+        csv_writer = writer(out_f)
+        csv_writer.writerow(HEADER)
+        for studentnr in studentnrs:
+            csv_writer.writerow(['Student', studentnr, 'u%s' % studentnr, studentnr, '', '', 'SMART_TEXT',
+                                 'x' * feedback_size, 'HTML'])
+    return (gradebook, gradecolumn, make_specs(spec_count))
+
+
+def add_arguments(parser):
+    parser.add_argument('--students', type=int, default=600, help='Number of students')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Weights of the submission types')
+    parser.add_argument('--files', type=int, default=5, help='Number of files in each submission')
+    parser.add_argument('--file-size', type=int, default=4096, help='Size of each file in bytes')
+    parser.add_argument('--specs', type=int, default=3, help='Number of specs')
+    parser.add_argument('--feedback-size', type=int, default=0, help='Size of the existing feedback in bytes')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic Blackboard cohort')
+    parser.add_argument('directory', help='Directory to generate the cohort in')
+    add_arguments(parser)
+    args = parser.parse_args()
+    generate(args.directory, students=args.students, mix=args.mix, files=args.files, file_size=args.file_size,
+             spec_count=args.specs, feedback_size=args.feedback_size, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
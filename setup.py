@@ -26,4 +26,7 @@ setup(name='Automarking',
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
+      entry_points={
+          'console_scripts': ['automarking = automarking.cli:main'],
+      },
 )
@@ -6,31 +6,173 @@
 Provides the :func:`~automarking.mark` function that takes a :class:`~automarking.core.BlackboardDataSource`
 and returns all the :class:`~automarking.core.SubmissionPart`\ s that have been identified from the
 :class:`~automarking.core.SubmissionSpec`\ s passed to the :class:`~automarking.core.BlackboardDataSource`.
+The :func:`~automarking.mark_parallel` function instead runs a marker function on all
+:class:`~automarking.core.SubmissionPart`\ s in a pool of worker processes.
+
+Modules that are slow to import, such as the process pool, the profiler, and the archive
+libraries, are only imported where they are used, so that importing :mod:`automarking`
+stays fast.
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
-from .core import BlackboardDataSource, SubmissionSpec
+import os
+
+from collections import deque
+from io import BytesIO
+from time import perf_counter
+
+from .core import BlackboardDataSource, BlackboardBatchDataSource, DuplicateIndex, SpooledFile, SubmissionSpec, SubmissionPart, merge_shards
+from .metrics import Metrics, NullMetrics
 
 
-def mark(source):
+def mark(source, duplicates=None):
     """Takes a :class:`~automarking.core.BlackboardDataSource` and iteratively yields each of the
     :class:`~automarking.core.SubmissionPart`\ s extracted from the :class:`~automarking.core.BlackboardDataSource`.
     In each iteration it yields a tuple (:class:`~automarking.core.SubmissionPart`, (filename, filedata)). If
     a student's :class:`~automarking.core.Submission` does not contain any data, then the inner tuple will be
     ``None``.
 
-    The function acts as a generator and can thus be used in ``for`` loops.
+    The function acts as a generator and can thus be used in ``for`` loops. If the ``source``
+    was created with the ``lazy`` option, each student's submission is only loaded when it
+    is reached and its data is released again once the next student's submission is loaded.
+
+    If a :class:`~automarking.core.DuplicateIndex` is passed as ``duplicates``, then only the
+    first of all :class:`~automarking.core.SubmissionPart`\ s with identical files is yielded.
+    The score and feedback it is given are copied to all the identical
+    :class:`~automarking.core.SubmissionPart`\ s, which are not yielded.
 
     :param source: The data source to load :class:`~automarking.core.SubmissionPart`\ s from.
     :type source: :class:`~automarking.core.BlackboardDataSource`
+    :param duplicates: The index to detect duplicate :class:`~automarking.core.SubmissionPart`\ s with
+    :type duplicates: :class:`~automarking.core.DuplicateIndex`
+
+    If the ``source`` has :class:`~automarking.metrics.Metrics`, then the time spent marking each
+    :class:`~automarking.core.SubmissionPart` is recorded as the ``mark`` phase and, if profiling
+    is enabled, profiled.
     """ 
+    metrics = getattr(source, 'metrics', None) or NullMetrics()
     with source as submissions:
         for submission in submissions:
             with submission as parts:
                 for part in parts:
                     with part as data:
-                        if isinstance(data, list):
-                            for sub_data in data:
-                                yield (part, sub_data)
-                        else:
-                            yield (part, data)
+                        if duplicates is not None:
+                            key = duplicates.add(submission.studentnr, part)
+                            if duplicates.apply(key, part):
+                                continue
+                        with metrics.phase('mark', submission.studentnr), metrics.profile():
+                            if isinstance(data, list):
+                                for sub_data in data:
+                                    yield (part, sub_data)
+                            else:
+                                yield (part, data)
+                        if duplicates is not None:
+                            duplicates.record(key, part)
+
+
+def mark_parallel(source, marker, workers=None, cache=None):
+    """Takes a :class:`~automarking.core.BlackboardDataSource` and runs the ``marker`` on each
+    of its :class:`~automarking.core.SubmissionPart`\ s in a pool of ``workers`` processes.
+
+    The ``marker`` is called with the same (:class:`~automarking.core.SubmissionPart`,
+    (filename, filedata)) arguments that :func:`~automarking.mark` yields and must set the
+    score and feedback on the :class:`~automarking.core.SubmissionPart` it is passed. As it
+    runs in a different process, the ``marker`` must be a module-level function. The scores
+    and feedback are copied back to the original :class:`~automarking.core.SubmissionPart`\ s,
+    which are then completed in the same order as :func:`~automarking.mark` would.
+
+    The function acts as a generator that yields each :class:`~automarking.core.Submission`
+    once all its :class:`~automarking.core.SubmissionPart`\ s have been marked.
+
+    :param source: The data source to load :class:`~automarking.core.SubmissionPart`\ s from.
+    :type source: :class:`~automarking.core.BlackboardDataSource`
+    :param marker: The function that marks a single :class:`~automarking.core.SubmissionPart`
+    :type marker: ``callable``
+    :param workers: The number of worker processes. Defaults to the number of CPUs.
+    :type workers: ``int``
+    :param cache: The cache to look up and store the results in, keyed by the data of the
+                  :class:`~automarking.core.SubmissionPart`, its :meth:`~automarking.core.SubmissionPart.spec_key`,
+                  and the ``marker``'s name. Set the cache's version when the ``marker`` changes.
+    :type cache: :class:`~automarking.cache.ResultCache`
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    metrics = getattr(source, 'metrics', None) or NullMetrics()
+    window = (workers if workers else os.cpu_count() or 1) * 2
+    marker_name = '%s.%s' % (marker.__module__, marker.__qualname__)
+    with source as submissions:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for submission in submissions:
+                futures, keys = zip(*[_submit_part(executor, marker, marker_name, part, cache, metrics)
+                                      for part in submission.parts]) if submission.parts else ((), ())
+                pending.append((submission, futures, keys))
+                while len(pending) > window:
+                    yield _complete_submission(metrics, *pending.popleft(), cache=cache)
+            while pending:
+                yield _complete_submission(metrics, *pending.popleft(), cache=cache)
+
+
+def _submit_part(executor, marker, marker_name, part, cache, metrics):
+    """Submit the ``part`` to be marked by the ``marker`` in the ``executor``, unless the
+    ``cache`` has a result for it.
+
+    :return: The future result of :func:`~automarking._mark_part` and the key to cache the
+             result under or ``None`` if it does not need to be cached
+    :rtype: ``tuple``
+    """
+    from concurrent.futures import Future
+    if cache is None:
+        return (executor.submit(_mark_part, marker, part.spec, part.assignment, _part_data(part)), None)
+    key = cache.key(part, marker_name, [part.spec_key()])
+    result = cache.get(key)
+    if result is not None:
+        metrics.count('cache hits')
+        future = Future()
+        future.set_result((result[0], result[1], 0))
+        return (future, None)
+    metrics.count('cache misses')
+    return (executor.submit(_mark_part, marker, part.spec, part.assignment, _part_data(part)), key)
+
+
+def _part_data(part):
+    """Copy the data of a :class:`~automarking.core.SubmissionPart` into a picklable ``list``
+    of (filename, ``bytes``) tuples or ``None`` if it has no data. Spilled files are not
+    copied, as they are read from the spool in the worker process when they are unpickled."""
+    if part.data is None:
+        return None
+    data = part.data if isinstance(part.data, list) else [part.data]
+    return [(filename, filedata if isinstance(filedata, SpooledFile) else filedata.getvalue())
+            for filename, filedata in data]
+
+
+def _mark_part(marker, spec, assignment, data):
+    """Run the ``marker`` on a copy of a :class:`~automarking.core.SubmissionPart` in a
+    worker process. The copy has the same spec and assignment as the original.
+
+    :return: The score and feedback set by the ``marker`` and the time it took
+    :rtype: ``tuple``
+    """
+    start = perf_counter()
+    part = SubmissionPart(spec)
+    part.assignment = assignment
+    if data is None:
+        marker(part, None)
+    else:
+        for filename, filedata in data:
+            marker(part, (filename, BytesIO(filedata)))
+    return (part.score, part.feedback, perf_counter() - start)
+
+
+def _complete_submission(metrics, submission, futures, keys, cache=None):
+    """Copy the results of the ``futures`` to the ``submission``\ 's
+    :class:`~automarking.core.SubmissionPart`\ s and complete the ``submission``. The
+    results that have a key in ``keys`` are stored in the ``cache``."""
+    with submission as parts:
+        for part, future, key in zip(parts, futures, keys):
+            with part:
+                part.score, feedback, duration = future.result()
+                part.feedback.extend(feedback)
+                metrics.record('mark', duration, submission.studentnr)
+                if key is not None:
+                    cache.put(key, part.score, feedback)
+    return submission
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+###############################################
+:mod:`automarking.cache` -- Test Result Caching
+###############################################
+
+The :class:`~automarking.cache.ResultCache` stores the score and feedback of test runs
+on disk, so that re-running the marking only runs the tests for submissions or tests
+that have changed.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import hashlib
+import json
+import os
+
+from tempfile import NamedTemporaryFile
+
+from .core import hash_file, remove_file
+
+
+class ResultCache(object):
+    """The :class:`~automarking.cache.ResultCache` stores results in a directory, one file
+    per result. The results are keyed by a hash of the submission data, the test command
+    and its parameters, and an optional harness version. When the total size of the
+    cached results exceeds ``max_size``, the least recently used results are evicted."""
+
+    def __init__(self, directory, max_size=100 * 1024 * 1024, version=None):
+        """:param directory: The directory to store the results in
+        :type directory: ``unicode``
+        :param max_size: The maximum total size of the cached results in bytes
+        :type max_size: ``int``
+        :param version: The version of the test harness. Changing the version
+                        invalidates all cached results.
+        :type version: ``unicode``"""
+        self.directory = directory
+        self.max_size = max_size
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self._entries())
+
+    def key(self, submission_file, command, parameters, settings=None):
+        """Generate the cache key for testing the ``submission_file`` with the
+        ``command`` and ``parameters``. Any ``settings`` that change the result of
+        the test, such as its timeout, are also part of the key.
+
+        :param submission_file: The :class:`~automarking.core.SubmissionPart` to test
+        :param command: The test command
+        :type command: ``unicode``
+        :param parameters: The test command's parameters
+        :type parameters: ``list``
+        :param settings: Further settings that the result depends on. Must be
+                         serialisable as JSON.
+        :type settings: ``dict``
+        :return: The cache key
+        :rtype: ``unicode``
+        """
+        key = hashlib.sha256()
+        key.update(json.dumps([self.version, command, parameters, settings], sort_keys=True).encode('utf-8'))
+        if submission_file.data is not None:
+            data = submission_file.data if isinstance(submission_file.data, list) else [submission_file.data]
+            for filename, filedata in data:
+                key.update(filename.encode('utf-8'))
+                key.update(b'\0')
+                key.update(hash_file(filedata))
+        return key.hexdigest()
+
+    def get(self, key):
+        """Get the cached result for the ``key``.
+
+        :param key: The cache key
+        :type key: ``unicode``
+        :return: The cached (score, feedback) or ``None`` if there is no cached result
+        :rtype: ``tuple``
+        """
+        path = os.path.join(self.directory, '%s.json' % key)
+        try:
+            with open(path, encoding='utf-8') as in_f:
+                score, feedback = json.load(in_f)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        return (score, feedback)
+
+    def put(self, key, score, feedback):
+        """Store the ``score`` and ``feedback`` for the ``key``, evicting the least
+        recently used results if the cache is full.
+
+        :param key: The cache key
+        :type key: ``unicode``
+        :param score: The score to cache
+        :type score: ``int``
+        :param feedback: The feedback to cache
+        :type feedback: ``list``
+        """
+        out_f = NamedTemporaryFile('w', encoding='utf-8', dir=self.directory, suffix='.tmp', delete=False)
+        try:
+            with out_f:
+                json.dump([score, feedback], out_f)
+            size = os.path.getsize(out_f.name)
+            os.replace(out_f.name, os.path.join(self.directory, '%s.json' % key))
+        except BaseException:
+            remove_file(out_f.name)
+            raise
+        self.size = self.size + size
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used results until the cache is at most
+        90% full."""
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                pass
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size = self.size - size
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.directory) if entry.name.endswith('.json')]
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+##############################################
+:mod:`automarking.cli` -- Command-line Marking
+##############################################
+
+The ``automarking`` command marks a Blackboard download with a marker function, using
+:func:`~automarking.mark_parallel`::
+
+    $ automarking gradebook.zip gradecolumn.csv specs.json markers:mark_java --workers 4 --progress
+
+The specs file contains a JSON list of objects with the ``identifier``, ``title``, and
+``pattern`` of each :class:`~automarking.core.SubmissionSpec`. The marker is given as
+``module:function``, where the function defaults to ``mark``. The module is imported
+from the current directory.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import hashlib
+import importlib
+import json
+import os
+import sys
+
+from argparse import ArgumentParser
+from zipfile import ZipFile
+
+from . import mark_parallel
+from .cache import ResultCache
+from .core import BlackboardDataSource, SubmissionSpec, index_gradebook, read_students
+
+
+def main(argv=None):
+    """Run the ``automarking`` command with the arguments ``argv``.
+
+    :param argv: The command-line arguments. Defaults to :data:`sys.argv`.
+    :type argv: ``list``
+    :return: The exit code
+    :rtype: ``int``
+    """
+    parser = ArgumentParser(prog='automarking', description='Mark the submissions in a Blackboard download')
+    parser.add_argument('gradebook', help='the gradebook ZIP file downloaded from Blackboard')
+    parser.add_argument('gradecolumn', help='the gradecolumn CSV file to write the scores and feedback to')
+    parser.add_argument('specs', nargs='?',
+                        help='the JSON file with the submission specs, not needed for --dry-run or --list-missing')
+    parser.add_argument('marker', nargs='?',
+                        help='the marker function as module:function, not needed for --dry-run or --list-missing')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='the number of worker processes, defaults to the number of CPUs')
+    parser.add_argument('--cache-dir', help='the directory to cache marking results in')
+    parser.add_argument('--progress', action='store_true', help='report the marking progress')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the gradebook entries that would be marked, without marking them')
+    parser.add_argument('--list-missing', action='store_true',
+                        help='list the students without a submission')
+    args = parser.parse_args(argv)
+    if args.list_missing:
+        for studentnr, entries in gradebook_entries(args.gradebook, args.gradecolumn):
+            if not entries:
+                print(studentnr)
+        return 0
+    if args.dry_run:
+        for studentnr, entries in gradebook_entries(args.gradebook, args.gradecolumn):
+            print('%s: %s' % (studentnr, ', '.join(entries) if entries else 'No submission'))
+        return 0
+    if args.specs is None or args.marker is None:
+        parser.error('the specs and marker are required, unless --dry-run or --list-missing is given')
+    specs = load_specs(args.specs)
+    marker, version = load_marker(args.marker)
+    cache = ResultCache(args.cache_dir, version=version) if args.cache_dir else None
+    total = len(read_students(args.gradecolumn))
+    students = set()
+    source = BlackboardDataSource(args.gradebook, args.gradecolumn, specs)
+    for submission in mark_parallel(source, marker, workers=args.workers, cache=cache):
+        students.add(submission.studentnr)
+        if args.progress:
+            sys.stderr.write('\r%i/%i students marked' % (len(students), total))
+            sys.stderr.flush()
+    if args.progress:
+        sys.stderr.write('\n')
+    return 0
+
+
+def load_specs(filename):
+    """Load the :class:`~automarking.core.SubmissionSpec`\\ s from the JSON file ``filename``.
+
+    :rtype: ``list`` of :class:`~automarking.core.SubmissionSpec`
+    """
+    with open(filename, encoding='utf-8') as in_f:
+        return [SubmissionSpec(spec['identifier'], spec['title'], spec['pattern']) for spec in json.load(in_f)]
+
+
+def load_marker(name):
+    """Import the marker function ``name``, given as ``module:function``.
+
+    :return: The marker function and a version that changes whenever the marker's module
+             changes, for use with the :class:`~automarking.cache.ResultCache`
+    :rtype: ``tuple``
+    """
+    module_name, _, function_name = name.partition(':')
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    module = importlib.import_module(module_name)
+    version = name
+    if getattr(module, '__file__', None):
+        with open(module.__file__, 'rb') as in_f:
+            version = '%s %s' % (name, hashlib.sha256(in_f.read()).hexdigest())
+    return (getattr(module, function_name or 'mark'), version)
+
+
+def gradebook_entries(gradebook, gradecolumn):
+    """List each student's entries in the ``gradebook``, without opening any of them. The
+    text files that Blackboard adds for each attempt are not listed.
+
+    :return: Generator of (student number, ``list`` of entry filenames) tuples, in the order
+             of the ``gradecolumn``
+    """
+    studentlist = read_students(gradecolumn)
+    with ZipFile(gradebook) as in_f:
+        index = index_gradebook(in_f, set(studentlist))
+    for studentnr in studentlist:
+        yield (studentnr, [filename for filename in index.get(studentnr, []) if not filename.endswith('.txt')])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
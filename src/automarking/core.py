@@ -10,16 +10,68 @@ that loads data from the files downloaded from by Blackboard.
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
+import errno
+import hashlib
+import io
+import json
 import os
 import re
-import tarfile
+import shutil
+import zlib
 
+from collections import deque
 from csv import DictReader, DictWriter
 from io import BytesIO
-from rarfile import RarFile, BadRarFile, NotRarFile
+from shutil import copyfileobj, copymode
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from threading import Lock
+from time import perf_counter
 from zipfile import ZipFile, BadZipFile
 
+from .metrics import NullMetrics
+
 STUDENTNR = re.compile(r'[0-9]{8,9}')
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def index_gradebook(gradebook, students=None):
+    """Index the entries in the ``gradebook`` by the student number embedded in
+    each entry's filename. The gradebook is scanned once, so that looking up a
+    student's entries does not require another pass over all entries.
+
+    As the assignment title can also contain numbers, an entry is indexed under the
+    first number in its filename that is one of the ``students``. Without ``students``,
+    the number that precedes ``_attempt`` is preferred.
+
+    :param gradebook: The gradebook to index
+    :type gradebook: :class:`~zipfile.ZipFile`
+    :param students: The student numbers to index the entries of
+    :type students: ``set``
+    :return: The entry filenames for each student number, in gradebook order
+    :rtype: ``dict`` of ``list``
+    """
+    index = {}
+    for filename in gradebook.namelist():
+        matches = list(STUDENTNR.finditer(filename))
+        if students is not None:
+            matches = [match for match in matches if match.group(0) in students]
+        else:
+            matches.sort(key=lambda match: not filename.startswith('_attempt', match.end()))
+        if matches:
+            index.setdefault(matches[0].group(0), []).append(filename)
+    return index
+
+
+def read_students(gradecolumn):
+    """Read the student numbers from the ``gradecolumn``.
+
+    :param gradecolumn: The name of the gradecolumn file
+    :type gradecolumn: ``unicode``
+    :return: The student numbers in the order of the gradecolumn
+    :rtype: ``list``
+    """
+    with open(gradecolumn, encoding='utf-8-sig') as in_f:
+        return [line['Student ID'] for line in DictReader(in_f)]
 
 
 class SubmissionSpec(object):
@@ -40,6 +92,10 @@ class SubmissionSpec(object):
         self.identifier = identifier
         self.title = title
         self.pattern = pattern
+        if isinstance(pattern, list):
+            self.patterns = [re.compile(p) for p in pattern]
+        else:
+            self.patterns = [re.compile(pattern)]
 
     def matches(self, filename):
         """Test whether the ``filename`` is matched by this
@@ -50,13 +106,56 @@ class SubmissionSpec(object):
         :return: ``True`` if the ``filename`` is matched, ``False`` otherwise
         :rtype: ``boolean``
         """
-        if isinstance(self.pattern, list):
-            for pattern in self.pattern:
-                if re.search(pattern, filename):
-                    return True
-            return False
+        for pattern in self.patterns:
+            if pattern.search(filename):
+                return True
+        return False
+
+
+class SpecMatcher(object):
+    """The :class:`~automarking.core.SpecMatcher` classifies filenames against a
+    ``list`` of :class:`~automarking.core.SubmissionSpec`\\ s at once. All patterns
+    are combined into a single regular expression, which rejects the filenames
+    that no :class:`~automarking.core.SubmissionSpec` matches with one search.
+    Only the remaining filenames are tested against the individual patterns."""
+
+    def __init__(self, specs, metrics=None):
+        """:param specs: The :class:`~automarking.core.SubmissionSpec`\\ s to match against
+        :type specs: ``list``
+        :param metrics: The metrics to record the matching time in
+        :type metrics: :class:`~automarking.metrics.Metrics`"""
+        self.specs = specs
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.patterns = [(index, pattern) for index, spec in enumerate(specs) for pattern in spec.patterns]
+        self.combined = None
+        if self.patterns and len(set(pattern.flags for _, pattern in self.patterns)) == 1:
+            sources = [pattern.pattern for _, pattern in self.patterns]
+            # Back-references and conditionals refer to group numbers, which change
+            # when the patterns are combined
+            if all(isinstance(source, str) and not BACKREFERENCE.search(source) for source in sources):
+                try:
+                    self.combined = re.compile('|'.join('(?:%s)' % source for source in sources),
+                                               self.patterns[0][1].flags)
+                except re.error:
+                    pass
+
+    def classify(self, filename):
+        """Determine which :class:`~automarking.core.SubmissionSpec`\\ s match the
+        ``filename``.
+
+        :param filename: The filename to classify
+        :type filename: ``unicode``
+        :return: The indices in ``specs`` of all matching :class:`~automarking.core.SubmissionSpec`\\ s.
+                 Indices are used rather than identifiers, as identifiers need not be unique.
+        :rtype: ``frozenset``
+        """
+        start = perf_counter()
+        if self.combined is not None and not self.combined.search(filename):
+            indices = frozenset()
         else:
-            return re.search(self.pattern, filename)
+            indices = frozenset([index for index, pattern in self.patterns if pattern.search(filename)])
+        self.metrics.record('match', perf_counter() - start)
+        return indices
 
 
 class BlackboardDataSource(object):
@@ -70,88 +169,458 @@ class BlackboardDataSource(object):
         :type gradecolumn:
         :param specs:
         :type specs: :py:class:`list`
-        :param options:
-        :type options:"""
+        :param options: Additional options. ``no_submission_message`` sets the feedback
+                        for students without a submission. If ``lazy`` is ``True``,
+                        the submissions are loaded one student at a time while
+                        iterating, instead of all at once. ``threads`` sets the number
+                        of threads to load the submissions with. ``manifest`` is the name
+                        of a file in which each student's gradebook entries and
+                        results are recorded. On the next run, only the students
+                        whose entries have changed are loaded and marked again.
+                        ``manifest_version`` can be changed to invalidate the manifest
+                        when the tests change. ``journal`` is the name of a file to which
+                        each student's result is appended as soon as it is marked. If
+                        the run is interrupted, the next run skips the students in the
+                        journal. Once the results are written back, the journal is
+                        removed. ``shard`` is a tuple (index, count) that restricts the
+                        run to the students in the shard with that index out of count
+                        shards, assigned by a stable hash of the student number. Instead of
+                        the gradecolumn, the results are then written to the file named by
+                        ``shard_results`` (by default the gradecolumn's name with the shard
+                        appended) and merged with :func:`~automarking.core.merge_shards`.
+                        Each shard needs its own ``manifest`` and ``journal``. ``metrics`` is a
+                        :class:`~automarking.metrics.Metrics` to record the run in.
+                        Files larger than ``spill_size`` bytes are spilled to a temporary file
+                        instead of being kept in memory. Files larger than
+                        ``max_file_size`` bytes and files that take a submission over
+                        ``max_submission_size`` bytes are not marked.
+        :type options: ``dict``"""
         self.gradebook_filename = gradebook
         self.gradecolumn_filename = gradecolumn
         self.specs = specs
         self.options = options if options is not None else {}
+        self.metrics = self.options['metrics'] if 'metrics' in self.options else NullMetrics()
+        self.matcher = SpecMatcher(specs, metrics=self.metrics)
+        self.limits = StorageLimits(memory=self.options['spill_size'] if 'spill_size' in self.options else 1024 * 1024,
+                                    file=self.options.get('max_file_size'),
+                                    submission=self.options.get('max_submission_size'))
 
     def __enter__(self):
-        if os.path.isdir('tmp'):
-            for root, dirs, files in os.walk('tmp', topdown=False):
-                for name in files:
-                    os.remove(os.path.join(root, name))
-                for name in dirs:
-                    os.rmdir(os.path.join(root, name))
-        else:
-            os.mkdir('tmp')
-        studentlist = []
-        with open(self.gradecolumn_filename, encoding='utf-8-sig') as in_f:
-            reader = DictReader(in_f)
-            for line in reader:
-                studentlist.append(line['Student ID'])
+        with self.metrics.phase('read gradecolumn'):
+            studentlist = read_students(self.gradecolumn_filename)
+        if 'shard' in self.options:
+            studentlist = [studentnr for studentnr in studentlist if in_shard(studentnr, *self.options['shard'])]
+        self.manifest = self._load_manifest()
+        self.journal = Journal(self.options['journal'], self._manifest_fingerprint()) if 'journal' in self.options else None
+        return self._load(studentlist)
+
+    def _load(self, studentlist):
+        """Load the :class:`~automarking.core.Submission`\\ s of the students in the
+        ``studentlist``, either all at once or, with the ``lazy`` option, one student
+        at a time.
+
+        :return: The :class:`~automarking.core.Submission`\\ s or a generator of them
+        """
+        self.entries = {}
+        if self.options.get('lazy', False):
+            self.submissions = []
+            return self._iter_submissions(studentlist)
         submissions = []
         with ZipFile(self.gradebook_filename) as in_f:
-            for studentnr in studentlist:
-                submitted = False
-                for filename in in_f.namelist():
-                    if studentnr in filename:
-                        target_filename = 'tmp/%s%s' % (studentnr, filename[filename.find('.'):])
-                        if filename.lower().endswith('.tar.bz2') or filename.endswith('.tar.gz'):
-                            with in_f.open(filename) as submission_file:
-                                with open(target_filename, 'wb') as out_f:
-                                    out_f.write(submission_file.read())
-                            submissions.append(TarSubmission(studentnr, self.specs, target_filename))
-                            submitted = True
-                        elif filename.lower().endswith('.zip'):
-                            with in_f.open(filename) as submission_file:
-                                with open(target_filename, 'wb') as out_f:
-                                    out_f.write(submission_file.read())
-                            submissions.append(ZipSubmission(studentnr, self.specs, target_filename))
-                            submitted = True
-                        elif filename.lower().endswith('.rar'):
-                            with in_f.open(filename) as submission_file:
-                                with open(target_filename, 'wb') as out_f:
-                                    out_f.write(submission_file.read())
-                            submissions.append(RarSubmission(studentnr, self.specs, target_filename))
-                            submitted = True
-                        elif filename.endswith('.txt'):
-                            pass
-                        else:
-                            submissions.append(MissingSubmission(studentnr, self.specs, message='Unknown submission type %s' % filename[filename.rfind('.'):]))
-                            submitted = True
-                if not submitted:
-                    submissions.append(MissingSubmission(studentnr, self.specs, message=self.options['no_submission_message'] if 'no_submission_message' in self.options else 'No submission'))
+            with self.metrics.phase('index'):
+                index = index_gradebook(in_f, set(studentlist))
+            for student_submissions in self._load_students(in_f, index, studentlist):
+                submissions.extend(student_submissions)
         self.submissions = submissions
         return self.submissions
 
+    def _iter_submissions(self, studentlist):
+        """Lazily load the :class:`~automarking.core.Submission`\\ s, one student at
+        a time. Once the next :class:`~automarking.core.Submission` is requested,
+        the data of the previous one is released, so that only its score and feedback
+        are kept for writing back to the gradecolumn."""
+        with ZipFile(self.gradebook_filename) as in_f:
+            with self.metrics.phase('index'):
+                index = index_gradebook(in_f, set(studentlist))
+            for student_submissions in self._load_students(in_f, index, studentlist):
+                for submission in student_submissions:
+                    self.submissions.append(submission)
+                    yield submission
+                    submission.release()
+
+    def _load_students(self, gradebook, index, studentlist):
+        """Load the :class:`~automarking.core.Submission`\\ s of all students in the
+        ``studentlist``. If the ``threads`` option is larger than 1, the students are
+        loaded on a pool of threads. At most twice as many students as there are
+        threads are loaded ahead of the student that is currently being yielded.
+
+        :return: Generator of each student's :class:`~automarking.core.Submission`\\ s,
+                 in the order of the ``studentlist``
+        """
+        threads = self.options['threads'] if 'threads' in self.options else 1
+        if threads <= 1:
+            for studentnr in studentlist:
+                yield self._load_student(gradebook, index, studentnr)
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=threads)
+        try:
+            pending = deque()
+            for studentnr in studentlist:
+                pending.append(executor.submit(self._load_student, gradebook, index, studentnr))
+                if len(pending) >= threads * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def _load_student(self, gradebook, index, studentnr):
+        """Load all :class:`~automarking.core.Submission`\\ s for the student
+        ``studentnr`` from the ``gradebook``.
+
+        :return: The student's :class:`~automarking.core.Submission`\\ s
+        :rtype: ``list``
+        """
+        entries = [[filename, gradebook.getinfo(filename).CRC, gradebook.getinfo(filename).file_size]
+                   for filename in index.get(studentnr, [])]
+        self.entries[studentnr] = entries
+        if self.journal is not None and studentnr in self.journal.results:
+            self.metrics.count('journal hits')
+            result = self.journal.results[studentnr]
+            return [CachedSubmission(studentnr, result['score'], result['feedback'])]
+        if entries and studentnr in self.manifest and self.manifest[studentnr]['entries'] == entries:
+            self.metrics.count('manifest hits')
+            return [CachedSubmission(studentnr, self.manifest[studentnr]['score'], self.manifest[studentnr]['feedback'])]
+        submissions = []
+        with self.metrics.phase('load', studentnr):
+            for filename in index.get(studentnr, []):
+                submission = self._open_submission(gradebook, studentnr, filename)
+                if submission is not None:
+                    submissions.append(submission)
+                    self.metrics.count('bytes matched', submission.size)
+                    for part in submission.parts:
+                        self.metrics.count('files matched', len(part.data) if isinstance(part.data, list) else 0 if part.data is None else 1)
+        if not submissions:
+            submissions.append(MissingSubmission(studentnr, self.specs, message=self.options['no_submission_message'] if 'no_submission_message' in self.options else 'No submission'))
+        # Only the last submission's result is written back, so only it is journaled
+        submissions[-1].journal = self.journal
+        return submissions
+
+    def _open_submission(self, gradebook, studentnr, filename):
+        """Open the gradebook entry ``filename`` as a :class:`~automarking.core.Submission`.
+        Tar archives are streamed directly from the gradebook. ZIP archives are read
+        from the gradebook into memory. RAR archives can only be read from a real file
+        and are spilled to a temporary file.
+
+        :return: The :class:`~automarking.core.Submission` or ``None`` if the entry
+                 is not a submission
+        """
+        if filename.lower().endswith('.tar.bz2') or filename.endswith('.tar.gz'):
+            self.metrics.count('bytes decompressed', gradebook.getinfo(filename).file_size)
+            with self.metrics.phase('open archive', studentnr):
+                with gradebook.open(filename) as source:
+                    return TarSubmission(studentnr, self.matcher, source, self.limits)
+        elif filename.lower().endswith('.zip'):
+            with self.metrics.phase('read gradebook entry', studentnr):
+                source = BytesIO(gradebook.read(filename))
+            self.metrics.count('bytes decompressed', len(source.getvalue()))
+            with self.metrics.phase('open archive', studentnr):
+                return ZipSubmission(studentnr, self.matcher, source, self.limits)
+        elif filename.lower().endswith('.rar'):
+            with NamedTemporaryFile(suffix='.rar') as out_f:
+                with self.metrics.phase('read gradebook entry', studentnr):
+                    with gradebook.open(filename) as submission_file:
+                        copyfileobj(submission_file, out_f)
+                    out_f.flush()
+                self.metrics.count('bytes decompressed', out_f.tell())
+                with self.metrics.phase('open archive', studentnr):
+                    return RarSubmission(studentnr, self.matcher, out_f.name, self.limits)
+        elif filename.endswith('.txt'):
+            return None
+        else:
+            return MissingSubmission(studentnr, self.specs, message='Unknown submission type %s' % filename[filename.rfind('.'):])
+
     def __exit__(self, type_, value, traceback):
         submissions = {}
         for submission in self.submissions:
             submissions[submission.studentnr] = submission
-        lines = []
-        score_field = None
-        with open(self.gradecolumn_filename, encoding='utf-8-sig') as in_f:
-            reader = DictReader(in_f)
-            fieldnames = [fn if fn != 'Feedback to Learner' else 'Feedback to User' for fn in reader.fieldnames]
-            for fieldname in fieldnames:
-                if 'Total Pts:' in fieldname:
-                    score_field = fieldname
-            for line in reader:
-                lines.append(line)
-        with open(self.gradecolumn_filename, 'w', encoding='utf-8-sig') as out_f:
-            writer = DictWriter(out_f, fieldnames=fieldnames)
-            writer.writeheader()
-            for line in lines:
-                if 'Feedback to Learner' in line:
-                    del line['Feedback to Learner']
-                if line['Student ID'] in submissions:
-                    line[score_field] = submissions[line['Student ID']].score
-                    line['Feedback to User'] = '\n'.join(submissions[line['Student ID']].feedback)
-                else:
-                    line[score_field] = 0
-                writer.writerow(line)
+        with self.metrics.phase('write-back'):
+            if 'shard' in self.options:
+                # A shard whose marking was interrupted would be merged as if it were complete
+                if type_ is None:
+                    self._write_shard(submissions)
+            else:
+                self._write_gradecolumn(submissions)
+        if 'manifest' in self.options:
+            self._save_manifest(submissions)
+        if self.journal is not None:
+            self.journal.close()
+            if type_ is None:
+                os.remove(self.journal.filename)
+        self.limits.spool.close()
+
+    def _write_gradecolumn(self, submissions, gradecolumn=None):
+        """Write the scores and feedback of the ``submissions`` to the gradecolumn. The
+        rows are merged one at a time into a temporary file, which then atomically
+        replaces the gradecolumn, so that the gradecolumn is never left half-written.
+
+        :param submissions: The :class:`~automarking.core.Submission` by student number
+        :type submissions: ``dict``
+        :param gradecolumn: The gradecolumn to write to. Defaults to the source's gradecolumn.
+        :type gradecolumn: ``unicode``
+        """
+        gradecolumn = gradecolumn if gradecolumn is not None else self.gradecolumn_filename
+        out_f = None
+        try:
+            with open(gradecolumn, encoding='utf-8-sig') as in_f:
+                reader = DictReader(in_f)
+                rename_feedback = 'Feedback to Learner' in reader.fieldnames
+                fieldnames = [fn if fn != 'Feedback to Learner' else 'Feedback to User' for fn in reader.fieldnames]
+                score_field = None
+                for fieldname in fieldnames:
+                    if 'Total Pts:' in fieldname:
+                        score_field = fieldname
+                with NamedTemporaryFile('w', encoding='utf-8-sig', dir=os.path.dirname(os.path.abspath(gradecolumn)),
+                                        delete=False) as out_f:
+                    writer = DictWriter(out_f, fieldnames=fieldnames)
+                    writer.writeheader()
+                    for line in reader:
+                        if rename_feedback:
+                            del line['Feedback to Learner']
+                        if line['Student ID'] in submissions:
+                            line[score_field] = submissions[line['Student ID']].score
+                            line['Feedback to User'] = '\n'.join(submissions[line['Student ID']].feedback)
+                        else:
+                            line[score_field] = 0
+                        writer.writerow(line)
+                    out_f.flush()
+                    os.fsync(out_f.fileno())
+            copymode(gradecolumn, out_f.name)
+            os.replace(out_f.name, gradecolumn)
+        except BaseException:
+            if out_f is not None:
+                remove_file(out_f.name)
+            raise
+
+    def _write_shard(self, submissions):
+        """Write the scores and feedback of the ``submissions`` to the ``shard_results``
+        file, in the same format as the :class:`~automarking.core.Journal`.
+
+        :param submissions: The :class:`~automarking.core.Submission` by student number
+        :type submissions: ``dict``
+        """
+        index, count = self.options['shard']
+        filename = self.options.get('shard_results', '%s.shard-%i-of-%i' % (self.gradecolumn_filename, index, count))
+        out_f = NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(os.path.abspath(filename)), delete=False)
+        try:
+            with out_f:
+                out_f.write('%s\n' % json.dumps({'fingerprint': self._manifest_fingerprint(), 'shard': [index, count]}))
+                for submission in submissions.values():
+                    out_f.write('%s\n' % json.dumps({'studentnr': submission.studentnr,
+                                                      'score': submission.score,
+                                                      'feedback': submission.feedback}))
+                out_f.flush()
+                os.fsync(out_f.fileno())
+            os.replace(out_f.name, filename)
+        except BaseException:
+            remove_file(out_f.name)
+            raise
+
+    def _manifest_fingerprint(self):
+        """Generate the fingerprint of the specs and ``manifest_version`` that the results
+        in the manifest are valid for."""
+        fingerprint = hashlib.sha256()
+        fingerprint.update(repr(self.options.get('manifest_version')).encode('utf-8'))
+        for spec in self.specs:
+            fingerprint.update(repr((spec.identifier, spec.title, [(pattern.pattern, pattern.flags) for pattern in spec.patterns])).encode('utf-8'))
+        return fingerprint.hexdigest()
+
+    def _load_manifest(self):
+        """Load the students' entries and results from the manifest. If there is no
+        manifest or it was created for different specs, no results are loaded.
+
+        :return: The entries, score, and feedback by student number
+        :rtype: ``dict``
+        """
+        if 'manifest' not in self.options or not os.path.exists(self.options['manifest']):
+            return {}
+        with open(self.options['manifest'], encoding='utf-8') as in_f:
+            manifest = json.load(in_f)
+        if manifest['fingerprint'] != self._manifest_fingerprint():
+            return {}
+        return manifest['students']
+
+    def _save_manifest(self, submissions):
+        """Save the entries and results of all completed ``submissions`` to the manifest.
+
+        :param submissions: The :class:`~automarking.core.Submission` by student number
+        :type submissions: ``dict``
+        """
+        students = {}
+        for studentnr, submission in submissions.items():
+            if submission.completed:
+                students[studentnr] = {'entries': self.entries[studentnr],
+                                       'score': submission.score,
+                                       'feedback': submission.feedback}
+        out_f = NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(os.path.abspath(self.options['manifest'])),
+                                   delete=False)
+        try:
+            with out_f:
+                json.dump({'fingerprint': self._manifest_fingerprint(), 'students': students}, out_f)
+            os.replace(out_f.name, self.options['manifest'])
+        except BaseException:
+            remove_file(out_f.name)
+            raise
+
+
+class BlackboardBatchDataSource(BlackboardDataSource):
+    """The :class:`~automarking.core.BlackboardBatchDataSource` loads the submissions for
+    several assignments from the same Blackboard download. Each student's submission is
+    only decompressed once and its files are matched against the specs of all assignments.
+
+    It provides one :class:`~automarking.core.Submission` per student and assignment, which
+    can be marked with :func:`~automarking.mark` and :func:`~automarking.mark_parallel`. The
+    ``assignment`` of each :class:`~automarking.core.Submission` and
+    :class:`~automarking.core.SubmissionPart` is the index of its assignment and the results
+    of each assignment are written back to its own gradecolumn. The parts keep the specs they
+    were given, so specs in different assignments may share an identifier. Duplicates and
+    cached results are therefore only shared between parts of the same assignment, as the
+    ``assignment`` is part of the :meth:`~automarking.core.SubmissionPart.spec_key`."""
+
+    def __init__(self, gradebook, assignments, options=None):
+        """:param gradebook: The gradebook ZIP file
+        :type gradebook: ``unicode``
+        :param assignments: The (gradecolumn, specs) of each assignment
+        :type assignments: ``list`` of ``tuple``
+        :param options: Additional options, as for the :class:`~automarking.core.BlackboardDataSource`.
+                        The ``manifest``, ``journal``, and ``shard`` options are not supported.
+        :type options: ``dict``
+        :raises ValueError: If any of the unsupported options are given"""
+        unsupported = [option for option in ('manifest', 'journal', 'shard', 'shard_results')
+                       if options is not None and option in options]
+        if unsupported:
+            raise ValueError('The options %s are not supported when marking several assignments' %
+                             ', '.join(unsupported))
+        self.assignments = assignments
+        # The specs are matched under identifiers that are unique across the assignments
+        self.batch_specs = {}
+        specs = []
+        for assignment, (_, assignment_specs) in enumerate(assignments):
+            for spec in assignment_specs:
+                batch_spec = SubmissionSpec((assignment, spec.identifier), spec.title, spec.pattern)
+                self.batch_specs[batch_spec] = (assignment, spec)
+                specs.append(batch_spec)
+        BlackboardDataSource.__init__(self, gradebook, None, specs, options)
+
+    def __enter__(self):
+        with self.metrics.phase('read gradecolumn'):
+            studentlists = [read_students(gradecolumn) for gradecolumn, _ in self.assignments]
+        self.students = [set(assignment_studentlist) for assignment_studentlist in studentlists]
+        studentlist = []
+        seen = set()
+        for assignment_studentlist in studentlists:
+            for studentnr in assignment_studentlist:
+                if studentnr not in seen:
+                    seen.add(studentnr)
+                    studentlist.append(studentnr)
+        self.manifest = {}
+        self.journal = None
+        return self._load(studentlist)
+
+    def _load_student(self, gradebook, index, studentnr):
+        """Load the student's :class:`~automarking.core.Submission`\\ s for all assignments
+        and split each into one :class:`~automarking.core.Submission` per assignment that the
+        student is listed in.
+
+        :return: The student's :class:`~automarking.core.Submission`\\ s
+        :rtype: ``list``
+        """
+        loaded = BlackboardDataSource._load_student(self, gradebook, index, studentnr)
+        parts = []
+        for submission in loaded:
+            submission_parts = [[] for _ in self.assignments]
+            for part in submission.parts:
+                part.assignment, part.spec = self.batch_specs[part.spec]
+                submission_parts[part.assignment].append(part)
+            parts.append(submission_parts)
+        submissions = []
+        for assignment in range(len(self.assignments)):
+            if studentnr in self.students[assignment]:
+                for submission, submission_parts in zip(loaded, parts):
+                    assignment_submission = Submission(studentnr)
+                    assignment_submission.assignment = assignment
+                    assignment_submission.parts = submission_parts[assignment]
+                    assignment_submission.feedback = list(submission.feedback)
+                    submissions.append(assignment_submission)
+        return submissions
+
+    def __exit__(self, type_, value, traceback):
+        submissions = [{} for _ in self.assignments]
+        for submission in self.submissions:
+            submissions[submission.assignment][submission.studentnr] = submission
+        with self.metrics.phase('write-back'):
+            for (gradecolumn, _), assignment_submissions in zip(self.assignments, submissions):
+                self._write_gradecolumn(assignment_submissions, gradecolumn)
+        self.limits.spool.close()
+
+
+def remove_file(filename):
+    """Remove the file ``filename``, ignoring that it may not exist. Used to clean up the
+    temporary files of writes that failed."""
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def in_shard(studentnr, index, count):
+    """Determine whether the student ``studentnr`` is in the shard ``index`` out of
+    ``count`` shards. The shards are assigned by the CRC32 of the student number, which
+    is the same in every process and on every machine.
+
+    :rtype: ``boolean``
+    """
+    return zlib.crc32(studentnr.encode('utf-8')) % count == index
+
+
+def merge_shards(gradecolumn, filenames):
+    """Merge the results of the shards in the ``filenames`` into the ``gradecolumn``.
+    The scores and feedback are written in the same way as by the
+    :class:`~automarking.core.BlackboardDataSource`.
+
+    :param gradecolumn: The gradecolumn to write the results into
+    :type gradecolumn: ``unicode``
+    :param filenames: The ``shard_results`` files of all shards
+    :type filenames: ``list``
+    :raises ValueError: If no shards are given, a file is not a shard's results, the shards
+                        were marked with different specs, or not all shards are given
+    """
+    filenames = list(filenames)
+    if not filenames:
+        raise ValueError('No shards to merge')
+    fingerprints = set()
+    shards = set()
+    counts = set()
+    submissions = {}
+    for filename in filenames:
+        with open(filename, encoding='utf-8') as in_f:
+            try:
+                header = json.loads(in_f.readline())
+            except ValueError:
+                header = None
+        if not isinstance(header, dict) or 'shard' not in header:
+            raise ValueError('%s does not contain the results of a shard' % filename)
+        fingerprints.add(header['fingerprint'])
+        shards.add(header['shard'][0])
+        counts.add(header['shard'][1])
+        for studentnr, result in read_journal(filename).items():
+            submissions[studentnr] = CachedSubmission(studentnr, result['score'], result['feedback'])
+    if len(fingerprints) > 1:
+        raise ValueError('The shards were marked with different specs')
+    if len(counts) > 1 or shards != set(range(counts.pop())):
+        raise ValueError('The shards %s do not form a complete set of shards' % ', '.join(filenames))
+    BlackboardDataSource(None, gradecolumn, [])._write_gradecolumn(submissions)
 
 
 class Submission(object):
@@ -161,6 +630,9 @@ class Submission(object):
         self.score = 0
         self.parts = []
         self.feedback = []
+        self.completed = False
+        self.size = 0
+        self.journal = None
 
     def __enter__(self):
         return self.parts
@@ -170,6 +642,31 @@ class Submission(object):
         for part in self.parts:
             self.score = self.score + part.score
             self.feedback.extend(part.feedback)
+        # A submission whose marking was interrupted must be marked again in the next run
+        if type_ is None:
+            self.completed = True
+            if self.journal is not None:
+                self.journal.record(self)
+
+    def release(self):
+        """Release the data of all :class:`~automarking.core.SubmissionPart`\\ s,
+        keeping only the score and feedback."""
+        for part in self.parts:
+            part.release()
+
+
+class CachedSubmission(Submission):
+    """A :class:`~automarking.core.Submission` that has already been marked in a previous
+    run and has no :class:`~automarking.core.SubmissionPart`\\ s to mark."""
+
+    def __init__(self, studentnr, score, feedback):
+        Submission.__init__(self, studentnr)
+        self.score = score
+        self.feedback = feedback
+        self.completed = True
+
+    def __exit__(self, type_, value, traceback):
+        pass
 
 
 class MissingSubmission(Submission):
@@ -179,73 +676,542 @@ class MissingSubmission(Submission):
         self.feedback.append(message)
 
 
-class TarSubmission(Submission):
+class ArchiveSubmission(Submission):
+    """Base class for the :class:`~automarking.core.Submission`\\ s loaded from an
+    archive. ``specs`` can either be a ``list`` of :class:`~automarking.core.SubmissionSpec`\\ s
+    or a :class:`~automarking.core.SpecMatcher`. The ``limits`` determine which files
+    are kept in memory, which are spilled to disk, and which are too large to be added."""
 
-    def __init__(self, studentnr, specs, source_filename):
+    def __init__(self, studentnr, specs, limits=None):
         Submission.__init__(self, studentnr)
+        self.matcher = specs if isinstance(specs, SpecMatcher) else SpecMatcher(specs)
+        self.limits = limits if limits is not None else StorageLimits()
+
+    def create_parts(self):
+        """Create one :class:`~automarking.core.SubmissionPart` for each
+        :class:`~automarking.core.SubmissionSpec`.
+
+        :return: The new :class:`~automarking.core.SubmissionPart`\\ s in the order of the specs
+        :rtype: ``list``
+        """
+        parts = [SubmissionPart(spec, self.studentnr) for spec in self.matcher.specs]
+        self.parts.extend(parts)
+        return parts
+
+    def accepts(self, parts, indices, filename, size):
+        """Check whether a file of ``size`` bytes is within the size limits. If it is, the
+        ``size`` is added to the submission's size. If it is not, the matching
+        :class:`~automarking.core.SubmissionPart`\\ s are given feedback explaining why the
+        file was not marked.
+
+        :return: ``True`` if the file can be added, ``False`` otherwise
+        :rtype: ``boolean``
+        """
+        if self.limits.file is not None and size > self.limits.file:
+            message = 'The file %s was not marked, as it is larger than the limit of %i bytes' % (filename, self.limits.file)
+        elif self.limits.submission is not None and self.size + size > self.limits.submission:
+            message = 'The file %s was not marked, as the submission is larger than the limit of %i bytes' % (filename, self.limits.submission)
+        else:
+            self.size = self.size + size
+            return True
+        for index in indices:
+            parts[index].feedback.append(message)
+        return False
+
+    def add_file(self, parts, indices, filename, size, source):
+        """Read ``size`` bytes from the file object ``source`` and add them to the matching
+        :class:`~automarking.core.SubmissionPart`\\ s. If the file cannot be spilled, because
+        too many files are open, the :class:`~automarking.core.SubmissionPart`\\ s are given
+        feedback explaining why the file was not marked."""
+        try:
+            data = store_data(source, size, self.limits)
+        except OSError as e:
+            if e.errno != errno.EMFILE:
+                raise
+            for index in indices:
+                parts[index].feedback.append('The file %s was not marked, as too many files are open' % filename)
+            return
+        for index in indices:
+            parts[index].add_data(filename, data)
+
+
+class TarSubmission(ArchiveSubmission):
+    """:class:`~automarking.core.Submission` loaded from a tar archive. The archive is read
+    as a stream, so that it is decompressed once and only the matched files are read.
+    The ``source`` does not need to be seekable."""
+
+    def __init__(self, studentnr, specs, source, limits=None):
+        import tarfile
+        ArchiveSubmission.__init__(self, studentnr, specs, limits)
         try:
-            source_file = tarfile.open(source_filename)
-            for spec in specs:
-                part = SubmissionPart(spec)
-                self.parts.append(part)
-                for filename in source_file.getnames():
-                    if spec.matches(filename):
-                        part.add_data(filename, source_file.extractfile(filename).read())
+            if isinstance(source, str):
+                source_file = tarfile.open(source, mode='r|*')
+            else:
+                source_file = tarfile.open(fileobj=source, mode='r|*')
+            with source_file:
+                parts = self.create_parts()
+                for member in source_file:
+                    if member.isfile():
+                        indices = self.matcher.classify(member.name)
+                        if indices and self.accepts(parts, indices, member.name, member.size):
+                            self.add_file(parts, indices, member.name, member.size,
+                                          source_file.extractfile(member))
         except tarfile.TarError:
             pass
 
 
-class ZipSubmission(Submission):
+class ZipSubmission(ArchiveSubmission):
 
-    def __init__(self, studentnr, specs, source_filename):
-        Submission.__init__(self, studentnr)
+    def __init__(self, studentnr, specs, source, limits=None):
+        ArchiveSubmission.__init__(self, studentnr, specs, limits)
         try:
-            source_file = ZipFile(source_filename)
-            for spec in specs:
-                part = SubmissionPart(spec)
-                self.parts.append(part)
-                for filename in source_file.namelist():
-                    if spec.matches(filename):
-                        part.add_data(filename, source_file.open(filename).read())
+            with ZipFile(source) as source_file:
+                parts = self.create_parts()
+                for info in source_file.infolist():
+                    indices = self.matcher.classify(info.filename)
+                    if indices and self.accepts(parts, indices, info.filename, info.file_size):
+                        with source_file.open(info) as in_f:
+                            self.add_file(parts, indices, info.filename, info.file_size, in_f)
         except BadZipFile:
             pass
 
 
-class RarSubmission(Submission):
+class RarSubmission(ArchiveSubmission):
+    """:class:`~automarking.core.Submission` loaded from a RAR archive. All matched
+    files are extracted in a single run of the external unrar or bsdtar tool, so that
+    each compressed or solid archive is only decompressed once."""
 
-    def __init__(self, studentnr, specs, source_filename):
-        Submission.__init__(self, studentnr)
+    def __init__(self, studentnr, specs, source, limits=None):
+        from rarfile import RarFile, BadRarFile, NotRarFile
+        ArchiveSubmission.__init__(self, studentnr, specs, limits)
         try:
-            source_file = RarFile(source_filename)
-            for spec in specs:
-                part = SubmissionPart(spec)
-                self.parts.append(part)
-                for filename in source_file.namelist():
-                    filename = filename.replace('\\', '/')
-                    info = source_file.getinfo(filename)
-                    if not info.isdir() and spec.matches(filename):
-                        part.add_data(filename, source_file.open(filename).read())
+            with RarFile(source) as source_file:
+                parts = self.create_parts()
+                matched = {}
+                for info in source_file.infolist():
+                    if not info.isdir():
+                        filename = info.filename.replace('\\', '/')
+                        indices = self.matcher.classify(filename)
+                        if indices and self.accepts(parts, indices, filename, info.file_size):
+                            matched[info.filename] = (filename, indices)
+                members = [info for info in source_file.infolist() if info.filename in matched]
+                for info, in_f in iter_rar_members(source_file, source, members, self.matcher.metrics):
+                    filename, indices = matched[info.filename]
+                    with in_f:
+                        self.add_file(parts, indices, filename, info.file_size, in_f)
         except BadRarFile:
             pass
         except NotRarFile:
             pass
 
 
+def iter_rar_members(source_file, source, members, metrics=None):
+    """Iterate over the ``members`` of a RAR archive. If any of the ``members`` are
+    compressed and the ``source`` is a file, then all ``members`` are extracted in one run
+    of the external unrar or bsdtar tool. Members that the tool fails to extract and
+    archives without compressed members are read through ``source_file``. Each member
+    that the tool should have extracted, but that has to be read through ``source_file``,
+    is counted in the ``rar fallbacks`` counter of the ``metrics``.
+
+    :param source_file: The opened archive
+    :type source_file: :class:`~rarfile.RarFile`
+    :param source: The archive's filename or file object
+    :param members: The members to read
+    :type members: ``list`` of :class:`~rarfile.RarInfo`
+    :param metrics: The metrics to count the fallbacks in
+    :type metrics: :class:`~automarking.metrics.Metrics`
+    :return: Generator of (:class:`~rarfile.RarInfo`, file object) tuples
+    """
+    import rarfile
+    import subprocess
+    metrics = metrics if metrics is not None else NullMetrics()
+    if not isinstance(source, str) or all(info.compress_type == rarfile.RAR_M0 for info in members):
+        for info in members:
+            yield (info, source_file.open(info))
+        return
+    with TemporaryDirectory() as tmpdir:
+        listfilename = os.path.join(tmpdir, 'members.lst')
+        outdir = os.path.join(tmpdir, 'out')
+        os.mkdir(outdir)
+        with open(listfilename, 'w', encoding='utf-8') as out_f:
+            for info in members:
+                out_f.write('%s\n' % info.filename)
+        if shutil.which(rarfile.UNRAR_TOOL):
+            # -scfl reads the list file as UTF-8
+            command = [rarfile.UNRAR_TOOL, 'x', '-y', '-idq', '-p-', '-scfl', source, '@%s' % listfilename,
+                       outdir + os.sep]
+        elif shutil.which(rarfile.BSDTAR_TOOL):
+            command = [rarfile.BSDTAR_TOOL, '-x', '-f', source, '-C', outdir, '-T', listfilename]
+        else:
+            command = None
+        if command is not None:
+            subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        realdir = os.path.realpath(outdir) + os.sep
+        for info in members:
+            path = os.path.realpath(os.path.join(outdir, info.filename))
+            if path.startswith(realdir) and os.path.isfile(path) and os.path.getsize(path) == info.file_size:
+                yield (info, open(path, 'rb'))
+            else:
+                metrics.count('rar fallbacks')
+                yield (info, source_file.open(info))
+
+
+class Journal(object):
+    """Append-only record of the results of completed :class:`~automarking.core.Submission`\\ s.
+    Each result is written to the file as a single line of JSON as soon as it is recorded,
+    so that the results survive the marking process crashing or being interrupted.
+
+    The results already in the file are loaded into ``results``, unless the file was written
+    for a different ``fingerprint``, in which case it is started afresh. Lines that were only
+    partially written are ignored."""
+
+    def __init__(self, filename, fingerprint):
+        """:param filename: The name of the journal file
+        :type filename: ``unicode``
+        :param fingerprint: The fingerprint of the specs that the results are valid for
+        :type fingerprint: ``unicode``"""
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.results = read_journal(filename, fingerprint)
+        self.lock = Lock()
+        if self.results is None:
+            self.results = {}
+            self.out_f = open(filename, 'w', encoding='utf-8')
+            self.out_f.write('%s\n' % json.dumps({'fingerprint': fingerprint}))
+            self.out_f.flush()
+        else:
+            self.out_f = open(filename, 'a+', encoding='utf-8')
+            # Terminate a partially written last line, so that it does not corrupt the next result
+            self.out_f.seek(self.out_f.seek(0, os.SEEK_END) - 1)
+            if self.out_f.read(1) != '\n':
+                self.out_f.write('\n')
+
+    def record(self, submission):
+        """Append the score and feedback of the ``submission`` to the journal."""
+        line = json.dumps({'studentnr': submission.studentnr,
+                           'score': submission.score,
+                           'feedback': submission.feedback})
+        with self.lock:
+            self.out_f.write('%s\n' % line)
+            self.out_f.flush()
+
+    def close(self):
+        """Close the journal file."""
+        self.out_f.close()
+
+
+def read_journal(filename, fingerprint=None):
+    """Read the results from the journal file ``filename``.
+
+    :param fingerprint: If set, the results are only read if the journal was written for
+                        this fingerprint
+    :type fingerprint: ``unicode``
+    :return: The score and feedback by student number or ``None`` if there is no journal
+             or it was written for a different ``fingerprint``
+    :rtype: ``dict``
+    """
+    if not os.path.exists(filename):
+        return None
+    results = {}
+    with open(filename, encoding='utf-8') as in_f:
+        try:
+            header = json.loads(in_f.readline())
+        except ValueError:
+            return None
+        if fingerprint is not None and header.get('fingerprint') != fingerprint:
+            return None
+        for line in in_f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            results[result['studentnr']] = {'score': result['score'], 'feedback': result['feedback']}
+    return results
+
+
+class StorageLimits(object):
+    """The :class:`~automarking.core.StorageLimits` determine how the files extracted from
+    the submissions are stored. Files up to ``memory`` bytes are kept in memory, larger
+    files are spilled to the ``spool``. Files larger than ``file`` bytes and files that
+    would take a submission over ``submission`` bytes are not added."""
+
+    def __init__(self, memory=1024 * 1024, file=None, submission=None):
+        """:param memory: The maximum size of files to keep in memory
+        :type memory: ``int``
+        :param file: The maximum size of a single file or ``None`` for no limit
+        :type file: ``int``
+        :param submission: The maximum total size of all files in a submission or
+                           ``None`` for no limit
+        :type submission: ``int``"""
+        self.memory = memory
+        self.file = file
+        self.submission = submission
+        self.spool = Spool()
+
+
+class Spool(object):
+    """Append-only temporary file that all spilled files are stored in, so that only a
+    single file descriptor is open, however many files are spilled. The temporary file
+    is only created when the first file is spilled and removed when the
+    :class:`~automarking.core.Spool` is closed.
+
+    Each file's space in the spool is reserved before it is copied, so that several
+    threads can copy files into the spool and read from it at the same time."""
+
+    def __init__(self):
+        self.file = None
+        self.end = 0
+        self.lock = Lock()
+
+    def write(self, source, size):
+        """Copy up to ``size`` bytes from the file object ``source`` into the spool.
+
+        :return: The offset and number of bytes written
+        :rtype: ``tuple``
+        """
+        with self.lock:
+            if self.file is None:
+                self.file = NamedTemporaryFile(prefix='spool-')
+            offset = self.end
+            self.end = self.end + size
+        written = 0
+        while written < size:
+            chunk = memoryview(source.read(min(size - written, 1024 * 1024)))
+            if not chunk:
+                break
+            while chunk:
+                count = os.pwrite(self.file.fileno(), chunk, offset + written)
+                chunk = chunk[count:]
+                written = written + count
+        return (offset, written)
+
+    def read(self, offset, size):
+        """Read ``size`` bytes starting at ``offset`` from the spool.
+
+        :rtype: ``bytes``
+        """
+        return os.pread(self.file.fileno(), size, offset)
+
+    def close(self):
+        """Close and remove the spool's temporary file."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.end = 0
+
+
+def store_data(source, size, limits):
+    """Read ``size`` bytes from the file object ``source``. If there are at most
+    ``limits.memory`` bytes, they are returned as ``bytes``, otherwise they are appended
+    to the ``limits.spool`` and returned as a :class:`~automarking.core.SpooledFile`."""
+    if size <= limits.memory:
+        return source.read(size)
+    offset, length = limits.spool.write(source, size)
+    if length == 0:
+        return b''
+    return SpooledFile(limits.spool, offset, length)
+
+
+class SpooledFile(io.RawIOBase):
+    """Read-only file object over a file stored in a :class:`~automarking.core.Spool`. Each
+    :class:`~automarking.core.SpooledFile` has its own position, so that several can share
+    the same stored file. Like :class:`~io.BytesIO`, it provides ``getvalue`` and ``getbuffer``,
+    but these read the whole file into memory. Use :func:`~automarking.core.hash_file` and
+    ``size`` instead where possible.
+
+    When it is pickled, for example to pass it to a worker process, only the spool's filename
+    and the file's location in it are pickled and it is unpickled as the ``bytes`` of the file."""
+
+    def __init__(self, spool, offset, size):
+        io.RawIOBase.__init__(self)
+        self.spool = spool
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def copy(self):
+        """Create another :class:`~automarking.core.SpooledFile` over the same stored file.
+
+        :rtype: :class:`~automarking.core.SpooledFile`
+        """
+        return SpooledFile(self.spool, self.offset, self.size)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset = self.position + offset
+        elif whence == io.SEEK_END:
+            offset = self.size + offset
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.position + size, self.size)
+        if end <= self.position:
+            return b''
+        data = self.spool.read(self.offset + self.position, end - self.position)
+        self.position = end
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readline(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.position + size, self.size)
+        chunks = []
+        while self.position < end:
+            chunk = self.spool.read(self.offset + self.position, min(end - self.position, 8192))
+            newline = chunk.find(b'\n')
+            if newline >= 0:
+                chunk = chunk[:newline + 1]
+            chunks.append(chunk)
+            self.position = self.position + len(chunk)
+            if newline >= 0:
+                break
+        return b''.join(chunks)
+
+    def getvalue(self):
+        return self.spool.read(self.offset, self.size)
+
+    def getbuffer(self):
+        return memoryview(self.getvalue())
+
+    def __reduce__(self):
+        return (read_spooled, (self.spool.file.name, self.offset, self.size))
+
+
+def read_spooled(filename, offset, size):
+    """Read ``size`` bytes starting at ``offset`` from the spool file ``filename``.
+
+    :rtype: ``bytes``
+    """
+    with open(filename, 'rb') as in_f:
+        in_f.seek(offset)
+        return in_f.read(size)
+
+
+def hash_file(filedata):
+    """Calculate the SHA-256 digest of the data in the file object ``filedata``. Spilled
+    files are read from their :class:`~automarking.core.Spool` in chunks, so that they are
+    never read into memory as a whole.
+
+    :rtype: ``bytes``
+    """
+    digest = hashlib.sha256()
+    if isinstance(filedata, SpooledFile):
+        for start in range(0, filedata.size, 1024 * 1024):
+            digest.update(filedata.spool.read(filedata.offset + start, min(filedata.size - start, 1024 * 1024)))
+    else:
+        with filedata.getbuffer() as view:
+            digest.update(view)
+    return digest.digest()
+
+
+class DuplicateIndex(object):
+    """The :class:`~automarking.core.DuplicateIndex` groups the :class:`~automarking.core.SubmissionPart`\\ s
+    by a hash of their spec, file names, and file contents. Only the first
+    :class:`~automarking.core.SubmissionPart` in each group needs to be marked, its score and
+    feedback are then copied to all other :class:`~automarking.core.SubmissionPart`\\ s in
+    the group. Only the base names of the files are hashed, so that the directory
+    structure in the archive does not prevent duplicates from being found."""
+
+    def __init__(self):
+        self.groups = {}
+        self.results = {}
+
+    def add(self, studentnr, part):
+        """Add the ``part`` of the student ``studentnr`` to the index. Parts without data
+        are not added, as students who did not submit a file are not duplicates of each other.
+
+        :return: The key of the ``part``\\ 's group or ``None`` if the ``part`` has no data
+        :rtype: ``unicode``
+        """
+        if part.data is None:
+            return None
+        key = hashlib.sha256(part.spec_key().encode('utf-8'))
+        data = part.data if isinstance(part.data, list) else [part.data]
+        for filename, filedata in data:
+            key.update(b'\0')
+            key.update(os.path.basename(filename).encode('utf-8'))
+            key.update(b'\0')
+            key.update(hash_file(filedata))
+        key = key.hexdigest()
+        self.groups.setdefault(key, []).append((studentnr, part))
+        return key
+
+    def apply(self, key, part):
+        """Copy the score and feedback of the group ``key`` to the ``part``.
+
+        :return: ``True`` if the group has already been marked and the results were
+                 copied, ``False`` if the ``part`` needs to be marked
+        :rtype: ``boolean``
+        """
+        if key not in self.results:
+            return False
+        part.score = self.results[key][0]
+        part.feedback.extend(self.results[key][1])
+        return True
+
+    def record(self, key, part):
+        """Record the score and feedback of the marked ``part`` for the group ``key``."""
+        if key is not None:
+            self.results[key] = (part.score, list(part.feedback))
+
+    def report(self):
+        """Generate a report of all groups of duplicate :class:`~automarking.core.SubmissionPart`\\ s,
+        largest group first.
+
+        :return: The spec identifier and student numbers of each group
+        :rtype: ``list`` of ``tuple``
+        """
+        groups = [(group[0][1].spec.identifier, [studentnr for studentnr, _ in group])
+                  for group in self.groups.values() if len(group) > 1]
+        groups.sort(key=lambda group: len(group[1]), reverse=True)
+        return groups
+
+
 class SubmissionPart(object):
 
-    def __init__(self, spec):
+    def __init__(self, spec, studentnr=None):
         self.spec = spec
+        self.studentnr = studentnr
+        self.assignment = None
         self.data = None
         self.score = 0
         self.feedback = []
 
     def add_data(self, filename, data):
+        data = data.copy() if isinstance(data, SpooledFile) else BytesIO(data)
         if self.data is None:
-            self.data = (filename, BytesIO(data))
+            self.data = (filename, data)
         elif isinstance(self.data, tuple):
-            self.data = [self.data, (filename, BytesIO(data))]
+            self.data = [self.data, (filename, data)]
         else:
-            self.data.append((filename, BytesIO(data)))
+            self.data.append((filename, data))
+
+    def spec_key(self):
+        """Generate the key that identifies the part's spec. As spec identifiers need not
+        be unique, the key also includes the spec's title and patterns and, for parts loaded
+        by a :class:`~automarking.core.BlackboardBatchDataSource`, the part's assignment.
+
+        :rtype: ``unicode``
+        """
+        return repr((self.assignment, self.spec.identifier, self.spec.title,
+                     [(pattern.pattern, pattern.flags) for pattern in self.spec.patterns]))
+
+    def release(self):
+        self.data = None
 
     def __enter__(self):
         return self.data
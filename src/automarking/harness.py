@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+####################################################
+:mod:`automarking.harness` -- Test Harness Workspaces
+####################################################
+
+Tests that use :func:`~automarking.tests.merge_code` merge each student's code into a
+base harness, which then has to be built before it can be tested. The
+:class:`~automarking.harness.Harness` builds the base harness once and then creates a
+:class:`~automarking.harness.Workspace` for each student, in which all files that do not
+depend on the student's code are hard links to the built base harness. Only the merged
+file is replaced and only the files built from it are rebuilt::
+
+    with Harness('template', 'src/Student.java', build=['javac', '-d', 'build', 'src/Test.java', 'src/Student.java'],
+                 rebuild=['javac', '-cp', 'build', '-d', 'build', 'src/Student.java'],
+                 cache='build-cache') as harness:
+        for part, data in mark(source):
+            with harness.workspace(data[1]) as workspace:
+                if workspace.returncode == 0:
+                    run_test('java', ['-cp', 'build', 'Test'], part, cwd=workspace.directory)
+                else:
+                    part.feedback.append(workspace.output)
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+
+from tempfile import TemporaryDirectory, mkdtemp
+
+from .tests import merge_code
+
+
+class Harness(object):
+    """The :class:`~automarking.harness.Harness` prepares the base harness from the
+    ``template`` directory when it is entered and removes it and all workspaces when
+    it is exited.
+
+    To find the files that depend on the student's code, the ``rebuild`` command is run
+    once more in the built base harness. All files that this changes are rebuilt in each
+    :class:`~automarking.harness.Workspace`. All other files are shared between the
+    workspaces and made read-only, so the tests must not modify them.
+
+    If a ``cache`` directory is given, the files built in each workspace are stored in it,
+    keyed by the hash of the merged code and the shared files, and a workspace with the
+    same merged code links them instead of building them again."""
+
+    def __init__(self, template, merged_file, build=None, rebuild=None, directory=None, cache=None, timeout=60,
+                 start_identifier='// StartStudentCode', end_identifier='// EndStudentCode'):
+        """:param template: The directory containing the base harness
+        :type template: ``unicode``
+        :param merged_file: The path of the file within the ``template`` that the student
+                            code is merged into
+        :type merged_file: ``unicode``
+        :param build: The command that builds the complete base harness
+        :type build: ``list``
+        :param rebuild: The command that builds the files that depend on the merged file.
+                        Defaults to the ``build`` command.
+        :type rebuild: ``list``
+        :param directory: The directory to create the base harness and workspaces in.
+                          Defaults to a temporary directory.
+        :type directory: ``unicode``
+        :param cache: The directory to cache the built files in
+        :type cache: ``unicode``
+        :param timeout: The timeout in seconds for building a workspace
+        :type timeout: ``int``
+        :param start_identifier: The line that starts the student code
+        :type start_identifier: ``unicode``
+        :param end_identifier: The line that ends the student code
+        :type end_identifier: ``unicode``"""
+        self.template = template
+        self.merged_file = os.path.normpath(merged_file)
+        self.build = build
+        self.rebuild = rebuild if rebuild is not None else build
+        self.directory = directory
+        self.cache = cache
+        self.timeout = timeout
+        self.start_identifier = start_identifier
+        self.end_identifier = end_identifier
+        self.temporary_directory = None
+        self.shared = []
+        self.digest = None
+
+    def __enter__(self):
+        if self.directory is None:
+            self.temporary_directory = TemporaryDirectory()
+            self.directory = self.temporary_directory.name
+        self.base = os.path.join(self.directory, 'base')
+        if os.path.exists(self.base):
+            shutil.rmtree(self.base)
+        shutil.copytree(self.template, self.base)
+        if self.cache is not None:
+            os.makedirs(self.cache, exist_ok=True)
+        if self.build is not None:
+            subprocess.run(self.build, cwd=self.base, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           check=True)
+        built = list_files(self.base)
+        rebuilt = set()
+        if self.rebuild is not None:
+            # Updating the merged file's modification time ensures that build tools that
+            # only rebuild what has changed rebuild everything that depends on it
+            os.utime(os.path.join(self.base, self.merged_file))
+            subprocess.run(self.rebuild, cwd=self.base, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           check=True)
+            rebuilt = set(path for path, state in list_files(self.base).items() if built.get(path) != state)
+        self.shared = [path for path in built if path not in rebuilt and path != self.merged_file]
+        digest = hashlib.sha256()
+        for path in sorted(self.shared):
+            make_readonly(os.path.join(self.base, path))
+            digest.update(json.dumps([path, built[path][1], file_hash(os.path.join(self.base, path))]).encode('utf-8'))
+        self.digest = digest.hexdigest()
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        shutil.rmtree(self.base)
+        if self.temporary_directory is not None:
+            self.temporary_directory.cleanup()
+            self.temporary_directory = None
+            self.directory = None
+
+    def workspace(self, overlay):
+        """Create a :class:`~automarking.harness.Workspace` with the student code from
+        the ``overlay`` merged into the base harness.
+
+        :param overlay: The file to take the student code from
+        :rtype: :class:`~automarking.harness.Workspace`
+        """
+        return Workspace(self, overlay)
+
+    def cache_key(self, merged):
+        """Generate the key that the files built from the ``merged`` code are cached under.
+        The key includes a digest of all shared files, so that the cached files are not used
+        once any other part of the base harness changes.
+
+        :param merged: The merged code
+        :type merged: ``bytes``
+        :rtype: ``unicode``
+        """
+        key = hashlib.sha256()
+        key.update(json.dumps([self.rebuild, self.digest]).encode('utf-8'))
+        key.update(b'\0')
+        key.update(merged)
+        return key.hexdigest()
+
+
+class Workspace(object):
+    """A student's copy of the base harness. When entered, the workspace is created and
+    built. If the build fails, ``returncode`` is non-zero and ``output`` contains the
+    build's output. The workspace is removed when it is exited."""
+
+    def __init__(self, harness, overlay):
+        """:param harness: The :class:`~automarking.harness.Harness` to create the
+                           workspace from
+        :param overlay: The file to take the student code from"""
+        self.harness = harness
+        self.overlay = overlay
+        self.directory = None
+        self.returncode = None
+        self.output = ''
+
+    def __enter__(self):
+        harness = self.harness
+        merged = merge_code(os.path.join(harness.base, harness.merged_file), self.overlay,
+                            start_identifier=harness.start_identifier,
+                            end_identifier=harness.end_identifier).encode('utf-8')
+        self.directory = mkdtemp(prefix='workspace-', dir=harness.directory)
+        for path in harness.shared:
+            link_file(os.path.join(harness.base, path), os.path.join(self.directory, path))
+        os.makedirs(os.path.dirname(os.path.join(self.directory, harness.merged_file)), exist_ok=True)
+        with open(os.path.join(self.directory, harness.merged_file), 'wb') as out_f:
+            out_f.write(merged)
+        if harness.rebuild is None:
+            self.returncode = 0
+            return self
+        key = harness.cache_key(merged)
+        if harness.cache is not None and os.path.exists(os.path.join(harness.cache, key, 'build.json')):
+            self._load_build(os.path.join(harness.cache, key))
+        else:
+            self._build()
+            if harness.cache is not None:
+                self._store_build(os.path.join(harness.cache, key))
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        shutil.rmtree(self.directory)
+
+    def _build(self):
+        """Run the ``rebuild`` command in the workspace."""
+        try:
+            result = subprocess.run(self.harness.rebuild, cwd=self.directory, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, timeout=self.harness.timeout)
+            self.returncode = result.returncode
+            self.output = result.stdout.decode('utf-8', 'replace')
+        except subprocess.TimeoutExpired:
+            self.returncode = None
+            self.output = 'Build failed due to timeout'
+
+    def _built_files(self):
+        """List the files in the workspace that were created by the build.
+
+        :rtype: ``list``
+        """
+        shared = set(self.harness.shared)
+        return [path for path in list_files(self.directory)
+                if path not in shared and path != self.harness.merged_file]
+
+    def _store_build(self, directory):
+        """Store the result of the build and the files it created in the cache ``directory``.
+        The build is first stored in a temporary directory that is then renamed, so that
+        concurrent workspaces never see a partially stored build."""
+        if self.returncode is None:
+            return
+        store = mkdtemp(prefix='.store-', dir=self.harness.cache)
+        for path in self._built_files():
+            link_file(os.path.join(self.directory, path), os.path.join(store, 'files', path))
+            make_readonly(os.path.join(store, 'files', path))
+        with open(os.path.join(store, 'build.json'), 'w', encoding='utf-8') as out_f:
+            json.dump({'returncode': self.returncode, 'output': self.output}, out_f)
+        try:
+            os.rename(store, directory)
+        except OSError:
+            # Another workspace with the same merged code stored its build first
+            shutil.rmtree(store)
+
+    def _load_build(self, directory):
+        """Link the files built for the same merged code from the cache ``directory``."""
+        with open(os.path.join(directory, 'build.json'), encoding='utf-8') as in_f:
+            build = json.load(in_f)
+        self.returncode = build['returncode']
+        self.output = build['output']
+        for path in list_files(os.path.join(directory, 'files')):
+            link_file(os.path.join(directory, 'files', path), os.path.join(self.directory, path))
+
+
+def list_files(directory):
+    """List all files below the ``directory`` with their modification time and size.
+
+    :return: The (modification time, size) by path relative to the ``directory``
+    :rtype: ``dict``
+    """
+    files = {}
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            state = os.stat(path)
+            files[os.path.relpath(path, directory)] = (state.st_mtime_ns, state.st_size)
+    return files
+
+
+def file_hash(filename):
+    """Calculate the SHA-256 hash of the contents of the file ``filename``.
+
+    :rtype: ``unicode``
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as in_f:
+        for chunk in iter(lambda: in_f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_file(source, target):
+    """Hard link the ``source`` file to the ``target``, creating the ``target``'s
+    directory if needed. If the file cannot be linked, it is copied instead."""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def make_readonly(filename):
+    """Remove all write permissions from the file ``filename``."""
+    os.chmod(filename, stat.S_IMODE(os.stat(filename).st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+##################################################
+:mod:`automarking.history` -- Test Runtime History
+##################################################
+
+The :class:`~automarking.history.RuntimeHistory` records how long each test took for
+each student, so that :func:`~automarking.tests.run_tests` can start the longest tests
+first and estimate when all tests will be completed.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import json
+import os
+
+from tempfile import NamedTemporaryFile
+
+from .core import SpooledFile
+
+
+class RuntimeHistory(object):
+    """The :class:`~automarking.history.RuntimeHistory` stores the runtime of each test
+    by student number in a JSON file. For each test it also keeps the sums needed to fit
+    the runtime as a linear function of the size of the tested files, which is used to
+    estimate the runtime for students that the test has not been run for before."""
+
+    def __init__(self, filename):
+        """:param filename: The name of the file to store the history in
+        :type filename: ``unicode``"""
+        self.filename = filename
+        if os.path.exists(filename):
+            with open(filename, encoding='utf-8') as in_f:
+                history = json.load(in_f)
+            self.runtimes = history['runtimes']
+            self.fits = history['fits']
+        else:
+            self.runtimes = {}
+            self.fits = {}
+
+    def test_key(self, command, submission_file):
+        """Generate the key that identifies the test ``command`` for the ``submission_file``,
+        independent of the student that the ``submission_file`` belongs to.
+
+        :rtype: ``unicode``
+        """
+        return '%s %s' % (command, submission_file.spec.identifier)
+
+    def estimate(self, command, submission_file):
+        """Estimate the runtime of testing the ``submission_file`` with the ``command``. If
+        the test has been run for the same student before, the last runtime is used.
+        Otherwise the runtime is estimated from the size of the ``submission_file``.
+
+        :return: The estimated runtime in seconds or ``None`` if the test has never been run
+        :rtype: ``float``
+        """
+        test = self.test_key(command, submission_file)
+        studentnr = getattr(submission_file, 'studentnr', None)
+        if studentnr in self.runtimes.get(test, {}):
+            return self.runtimes[test][studentnr]
+        if test not in self.fits:
+            return None
+        count, size_sum, runtime_sum, size_squares, products = self.fits[test]
+        size = data_size(submission_file)
+        variance = count * size_squares - size_sum * size_sum
+        if variance <= 0:
+            return runtime_sum / count
+        slope = (count * products - size_sum * runtime_sum) / variance
+        intercept = (runtime_sum - slope * size_sum) / count
+        return max(intercept + slope * size, 0)
+
+    def record(self, command, submission_file, runtime):
+        """Record that testing the ``submission_file`` with the ``command`` took ``runtime``
+        seconds."""
+        test = self.test_key(command, submission_file)
+        studentnr = getattr(submission_file, 'studentnr', None)
+        if studentnr is not None:
+            self.runtimes.setdefault(test, {})[studentnr] = runtime
+        size = data_size(submission_file)
+        count, size_sum, runtime_sum, size_squares, products = self.fits.get(test, (0, 0, 0, 0, 0))
+        self.fits[test] = (count + 1, size_sum + size, runtime_sum + runtime,
+                           size_squares + size * size, products + size * runtime)
+
+    def save(self):
+        """Save the history to its file."""
+        with NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(os.path.abspath(self.filename)),
+                                delete=False) as out_f:
+            json.dump({'runtimes': self.runtimes, 'fits': self.fits}, out_f)
+        os.replace(out_f.name, self.filename)
+
+
+def data_size(submission_file):
+    """Calculate the total size in bytes of the files in the ``submission_file``.
+
+    :rtype: ``int``
+    """
+    if submission_file.data is None:
+        return 0
+    data = submission_file.data if isinstance(submission_file.data, list) else [submission_file.data]
+    size = 0
+    for _, filedata in data:
+        if isinstance(filedata, SpooledFile):
+            size = size + filedata.size
+        else:
+            with filedata.getbuffer() as view:
+                size = size + view.nbytes
+    return size
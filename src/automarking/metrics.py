@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+#################################################
+:mod:`automarking.metrics` -- Run Instrumentation
+#################################################
+
+The :class:`~automarking.metrics.Metrics` object records how long each phase of a
+marking run takes, per student and in total, together with counters such as the number
+of bytes of submission archives decompressed from the gradebook, the number of bytes and
+files matched in the archives, and the number of test subprocesses run. Pass it to the
+:class:`~automarking.core.BlackboardDataSource` using the ``metrics`` option and to
+:func:`~automarking.tests.run_test` and :func:`~automarking.tests.run_tests`, then use
+:meth:`~automarking.metrics.Metrics.report` to summarise the run.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import threading
+
+from contextlib import contextmanager
+from io import StringIO
+from time import perf_counter
+
+
+class Metrics(object):
+    """The :class:`~automarking.metrics.Metrics` records phase durations and counters.
+    It can be shared between threads."""
+
+    def __init__(self, profile=False, callback=None):
+        """:param profile: Whether to profile each marker invocation in :func:`~automarking.mark`
+                           with :mod:`cProfile`
+        :type profile: ``boolean``
+        :param callback: Function that is called with the phase name, duration, and student
+                         number whenever a phase duration is recorded
+        :type callback: ``callable``"""
+        self.lock = threading.Lock()
+        self.started = perf_counter()
+        self.phases = {}
+        self.students = {}
+        self.counters = {}
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        self.callback = callback
+
+    @contextmanager
+    def phase(self, name, studentnr=None):
+        """Context manager that records the duration of its body as the phase ``name``."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - start, studentnr)
+
+    @contextmanager
+    def profile(self):
+        """Context manager that profiles its body, if profiling is enabled."""
+        if self.profiler is None:
+            yield
+        else:
+            self.profiler.enable()
+            try:
+                yield
+            finally:
+                self.profiler.disable()
+
+    def record(self, name, duration, studentnr=None):
+        """Record that the phase ``name`` took ``duration`` seconds, optionally for the
+        student ``studentnr``."""
+        with self.lock:
+            count, total, longest = self.phases.get(name, (0, 0, 0))
+            self.phases[name] = (count + 1, total + duration, max(longest, duration))
+            if studentnr is not None:
+                student = self.students.setdefault(studentnr, {})
+                student[name] = student.get(name, 0) + duration
+        if self.callback is not None:
+            self.callback(name, duration, studentnr)
+
+    def count(self, name, value=1):
+        """Increase the counter ``name`` by ``value``."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self, students=5, functions=20):
+        """Generate a summary report of the run.
+
+        :param students: The number of slowest students to list
+        :type students: ``int``
+        :param functions: The number of functions to list from the profile
+        :type functions: ``int``
+        :return: The report
+        :rtype: ``unicode``
+        """
+        lines = ['Total run time: %.2fs' % (perf_counter() - self.started), '']
+        with self.lock:
+            lines.append('%-24s %8s %10s %10s %10s' % ('Phase', 'Count', 'Total (s)', 'Mean (s)', 'Max (s)'))
+            for name, (count, total, longest) in sorted(self.phases.items(), key=lambda item: item[1][1], reverse=True):
+                lines.append('%-24s %8i %10.3f %10.4f %10.4f' % (name, count, total, total / count, longest))
+            if self.counters:
+                lines.append('')
+                for name, value in sorted(self.counters.items()):
+                    lines.append('%-24s %8i' % (name, value))
+            if self.students and students > 0:
+                lines.append('')
+                lines.append('Slowest students:')
+                slowest = sorted(self.students.items(), key=lambda item: sum(item[1].values()), reverse=True)
+                for studentnr, phases in slowest[:students]:
+                    lines.append('%-24s %s' % (studentnr, ', '.join('%s %.3fs' % item for item in sorted(phases.items()))))
+        if self.profiler is not None:
+            import pstats
+            buffer = StringIO()
+            pstats.Stats(self.profiler, stream=buffer).sort_stats('cumulative').print_stats(functions)
+            lines.append('')
+            lines.append(buffer.getvalue())
+        return '\n'.join(lines)
+
+
+class NullMetrics(Metrics):
+    """:class:`~automarking.metrics.Metrics` that records nothing, used when no
+    :class:`~automarking.metrics.Metrics` are passed."""
+
+    def __init__(self):
+        Metrics.__init__(self)
+
+    @contextmanager
+    def phase(self, name, studentnr=None):
+        yield
+
+    def record(self, name, duration, studentnr=None):
+        pass
+
+    def count(self, name, value=1):
+        pass
@@ -6,65 +6,614 @@
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
-from io import StringIO, BytesIO
-from subprocess import Popen, PIPE, TimeoutExpired
+import asyncio
+import codecs
+import os
+import re
+import signal
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from subprocess import Popen, PIPE
+from threading import Thread
+from time import monotonic
+
+from .history import data_size
+from .metrics import NullMetrics
 
 
 def extract_code(source, start_identifier='// StartStudentCode', end_identifier='// EndStudentCode'):
-    pre = []
-    code = []
-    post = []
-    state = 0
-    if isinstance(source, BytesIO):
+    """Split the ``source`` into the code before, between, and after the lines
+    ``start_identifier`` and ``end_identifier``. Binary sources are decoded once, as
+    UTF-8 if possible and otherwise as Latin-1.
+
+    :param source: The source file to split
+    :param start_identifier: The line that starts the student code
+    :type start_identifier: ``unicode``
+    :param end_identifier: The line that ends the student code
+    :type end_identifier: ``unicode``
+    :return: The code before, between, and after the identifier lines
+    :rtype: ``tuple``
+    """
+    return _split_code(_read_code(source), start_identifier, end_identifier)
+
+
+def _read_code(source):
+    """Read the text from the ``source``, which can be a binary or text file or an
+    iterable of lines."""
+    if not hasattr(source, 'read'):
+        return ''.join(source)
+    text = source.read()
+    if isinstance(text, bytes):
         try:
-            source = StringIO(source.read().decode('utf-8'))
+            text = text.decode('utf-8')
         except UnicodeDecodeError:
-            try:
-                source = StringIO(source.read().decode('latin-1'))
-            except UnicodeDecodeError:
-                try:
-                     source = StringIO(source.read().decode('ascii'))
-                except UnicodeDecodeError:
-                    print('Could not decode file')
-                    sourced = StringIO('')
-    for line in source:
-        if state == 0 and line.strip() == start_identifier:
-            state = 1
-        elif state == 1 and line.strip() == end_identifier:
-            state = 2
-        elif state == 0:
-            pre.append(line)
-        elif state == 1:
-            code.append(line)
-        elif state == 2:
-            post.append(line)
-    return ('\n'.join(pre), '\n'.join(code), '\n'.join(post))
+            text = text.decode('latin-1')
+    return text
+
+
+def _find_line(text, identifier, start):
+    """Find the first line from the offset ``start`` that consists only of the ``identifier``
+    and surrounding whitespace.
+
+    :return: The offsets of the start of the line and of the start of the next line
+             or ``None`` if there is no such line
+    :rtype: ``tuple``
+    """
+    idx = text.find(identifier, start)
+    while idx >= 0:
+        line_start = text.rfind('\n', start, idx)
+        line_start = start if line_start < 0 else line_start + 1
+        line_end = text.find('\n', idx)
+        line_end = len(text) if line_end < 0 else line_end + 1
+        if text[line_start:line_end].strip() == identifier:
+            return (line_start, line_end)
+        idx = text.find(identifier, idx + 1)
+    return None
+
+
+def _join_lines(text):
+    """Separate the lines of the ``text`` by an additional newline, in the same way
+    that joining the lines with newlines would."""
+    if text.endswith('\n'):
+        return text[:-1].replace('\n', '\n\n') + '\n'
+    return text.replace('\n', '\n\n')
+
+
+def _split_code(text, start_identifier, end_identifier):
+    start = _find_line(text, start_identifier, 0)
+    if start is None:
+        return (_join_lines(text), '', '')
+    end = _find_line(text, end_identifier, start[1])
+    if end is None:
+        return (_join_lines(text[:start[0]]), _join_lines(text[start[1]:]), '')
+    return (_join_lines(text[:start[0]]), _join_lines(text[start[1]:end[0]]), _join_lines(text[end[1]:]))
+
+
+@lru_cache(maxsize=32)
+def _parse_template(filename, modified, size, start_identifier, end_identifier):
+    with open(filename, 'rb') as in_f:
+        pre, _, post = extract_code(in_f, start_identifier, end_identifier)
+    return (pre, post)
 
 
 def merge_code(base, overlay, start_identifier='// StartStudentCode', end_identifier='// EndStudentCode'):
-    pre, _, post = extract_code(base, start_identifier, end_identifier)
+    """Replace the student code in the ``base`` with the student code from the ``overlay``.
+
+    If the ``base`` is a filename, then the parsed ``base`` is cached, so that merging many
+    ``overlay``\\ s into the same ``base`` only parses it once. The cache is invalidated when
+    the file changes.
+
+    :param base: The template to merge into, either a filename or a file
+    :param overlay: The file to take the student code from
+    :param start_identifier: The line that starts the student code
+    :type start_identifier: ``unicode``
+    :param end_identifier: The line that ends the student code
+    :type end_identifier: ``unicode``
+    :return: The merged code
+    :rtype: ``unicode``
+    """
+    if isinstance(base, str):
+        stat = os.stat(base)
+        pre, post = _parse_template(os.path.abspath(base), stat.st_mtime_ns, stat.st_size, start_identifier,
+                                    end_identifier)
+    else:
+        pre, _, post = extract_code(base, start_identifier, end_identifier)
     _, code, _ = extract_code(overlay, start_identifier, end_identifier)
     return '\n'.join([pre, code, post])
 
 
-def run_test(command, parameters, submission_file, timeout=60):
-    with Popen([command] + parameters, stdout=PIPE, stderr=PIPE) as process:
-        try:
-            stdout, stderr = process.communicate(timeout=timeout)
-            stdout = stdout.decode('utf-8')
-            stderr = stderr.decode('utf-8')
-        except TimeoutExpired:
-            process.kill()
-            stdout = None
-            stderr = 'Test failed due to timeout'
-        if process.returncode == 0:
-            submission_file.score = 2
-            if stdout:
-                submission_file.feedback.append(stdout)
-        else:
-            submission_file.score = 1
-            if stdout:
-                submission_file.feedback.append(stdout)
-            if stderr:
-                submission_file.feedback.append(stderr)
-    
\ No newline at end of file
+HEAD_LIMIT = 32768
+TAIL_LIMIT = 32768
+
+
+MEMORY_ERRORS = re.compile(r'MemoryError|OutOfMemoryError|std::bad_alloc|Cannot allocate memory')
+PROCESS_ERRORS = re.compile(r'Resource temporarily unavailable|unable to create (?:new )?native thread')
+
+# Sets the resource limits given as NAME:SOFT:HARD,... and then replaces itself with the test command
+LIMITS_HELPER = """import os, resource, sys
+for rlimit in sys.argv[1].split(','):
+    name, soft, hard = rlimit.split(':')
+    resource.setrlimit(getattr(resource, name), (int(soft), int(hard)))
+try:
+    os.execvp(sys.argv[2], sys.argv[2:])
+except OSError as e:
+    sys.stderr.write('%s: %s\\n' % (sys.argv[2], e.strerror))
+    sys.exit(127)
+"""
+
+
+class Limits(object):
+    """The resource limits that a test runs under. Each limit that is ``None`` is not
+    restricted.
+
+    :param cpu: The CPU time in seconds
+    :type cpu: ``int``
+    :param memory: The address space in bytes
+    :type memory: ``int``
+    :param files: The number of open files
+    :type files: ``int``
+    :param processes: The number of processes. As this limit applies per user, it should
+                      be set with some room for the other processes that the user runs.
+    :type processes: ``int``
+    :param file_size: The size in bytes of any file that the test writes
+    :type file_size: ``int``
+    """
+
+    def __init__(self, cpu=None, memory=None, files=None, processes=None, file_size=None):
+        self.cpu = cpu
+        self.memory = memory
+        self.files = files
+        self.processes = processes
+        self.file_size = file_size
+
+    def wrap(self, command):
+        """Wrap the ``command`` so that it runs under the limits. The limits are set by a
+        small helper process that then replaces itself with the ``command``, so that no
+        Python code has to run between forking and starting the test, which is unsafe
+        while the marking process runs other threads. If the ``command`` cannot be
+        started, the helper exits with the return code 127.
+
+        :param command: The test command and its parameters
+        :type command: ``list``
+        :return: The wrapped command
+        :rtype: ``list``
+        """
+        rlimits = []
+        if self.cpu is not None:
+            # The hard limit is one second later, so that the test first receives the
+            # SIGXCPU that identifies the reason it was stopped
+            rlimits.append(('RLIMIT_CPU', self.cpu, self.cpu + 1))
+        if self.memory is not None:
+            rlimits.append(('RLIMIT_AS', self.memory, self.memory))
+        if self.files is not None:
+            rlimits.append(('RLIMIT_NOFILE', self.files, self.files))
+        if self.processes is not None:
+            rlimits.append(('RLIMIT_NPROC', self.processes, self.processes))
+        if self.file_size is not None:
+            rlimits.append(('RLIMIT_FSIZE', self.file_size, self.file_size))
+        if not rlimits:
+            return command
+        return ([sys.executable, '-I', '-S', '-c', LIMITS_HELPER,
+                 ','.join('%s:%i:%i' % rlimit for rlimit in rlimits)] + command)
+
+    def breach(self, returncode, stderr, cpu=None):
+        """Determine whether a test that exited with the ``returncode``, wrote ``stderr``,
+        and used ``cpu`` seconds CPU time failed because it reached one of the limits.
+
+        Breaches of the CPU time and file size limits are identified by the signal that
+        stopped the test, or that stopped a command run by a test shell script. A test
+        that ignores the SIGXCPU is killed at the hard CPU time limit, but as the test
+        can also be killed for other reasons, such as running out of memory, this only
+        counts as a breach if the test's ``cpu`` time is past the CPU time limit. It is
+        not compared with the hard limit itself, as the reported CPU time can fall
+        slightly short of the time at which the test was killed. Breaches of
+        the memory and process limits only show as failed allocations or forks, which are
+        identified by the test's error output.
+
+        :return: The feedback describing the breached limit or ``None``
+        :rtype: ``unicode``
+        """
+        if returncode == 0 or returncode is None:
+            return None
+        if self.cpu is not None and (returncode in (-signal.SIGXCPU, 128 + signal.SIGXCPU)
+                                     or (returncode == -signal.SIGKILL and cpu is not None and cpu >= self.cpu)):
+            return 'Test failed, as it used more than the limit of %i seconds CPU time' % self.cpu
+        if self.file_size is not None and returncode in (-signal.SIGXFSZ, 128 + signal.SIGXFSZ):
+            return 'Test failed, as it wrote a file larger than the limit of %i bytes' % self.file_size
+        if self.memory is not None and stderr and MEMORY_ERRORS.search(stderr):
+            return 'Test failed, as it used more than the limit of %i bytes memory' % self.memory
+        if self.processes is not None and stderr and PROCESS_ERRORS.search(stderr):
+            return 'Test failed, as it started more than the limit of %i processes' % self.processes
+        return None
+
+
+def run_test(command, parameters, submission_file, timeout=60, cache=None, metrics=None,
+             head_limit=HEAD_LIMIT, tail_limit=TAIL_LIMIT, log=None, limits=None, cwd=None):
+    """Run the test ``command`` with the ``parameters`` and score the ``submission_file``
+    using :func:`~automarking.tests.score_test`.
+
+    The test's output is read while the test runs and only the first ``head_limit`` and
+    last ``tail_limit`` bytes of each stream are kept, so that a test that produces
+    large amounts of output neither fills the memory nor the feedback.
+
+    The test runs in its own process group, which is killed once the test exits or times
+    out, so that no process that the test started outlives it. If ``limits`` are given,
+    the test runs under these and a test that fails by reaching one of them receives
+    feedback on which limit it reached.
+
+    :param command: The test command to run
+    :type command: ``unicode``
+    :param parameters: The test command's parameters
+    :type parameters: ``list``
+    :param submission_file: The :class:`~automarking.core.SubmissionPart` to score
+    :param timeout: The timeout in seconds, after which the test is killed
+    :type timeout: ``int``
+    :param cache: The cache to look up and store the result in. If there is a cached
+                  result for the same test, timeout, and limits, the test is not run.
+                  Results of tests that timed out are not cached.
+    :type cache: :class:`~automarking.cache.ResultCache`
+    :param metrics: The metrics to record the test run in
+    :type metrics: :class:`~automarking.metrics.Metrics`
+    :param head_limit: The number of bytes to keep from the start of each output stream
+    :type head_limit: ``int``
+    :param tail_limit: The number of bytes to keep from the end of each output stream
+    :type tail_limit: ``int``
+    :param log: If set, the complete output is also written to the files ``log + '.stdout'``
+                and ``log + '.stderr'``
+    :type log: ``unicode``
+    :param limits: The resource limits to run the test under
+    :type limits: :class:`~automarking.tests.Limits`
+    :param cwd: The directory to run the test in, such as the directory of a
+                :class:`~automarking.harness.Workspace`
+    :type cwd: ``unicode``
+    :return: The test's resource usage with the keys ``returncode``, ``wall`` and ``cpu``
+             time in seconds, the maximum ``memory`` in bytes, and whether it ``timed_out``.
+             ``None`` if a cached result was used.
+    :rtype: ``dict``
+    """
+    metrics = metrics if metrics is not None else NullMetrics()
+    key = None
+    if cache is not None:
+        key = cache.key(submission_file, command, parameters,
+                        {'timeout': timeout, 'head_limit': head_limit, 'tail_limit': tail_limit,
+                         'limits': vars(limits) if limits is not None else None})
+    if _apply_cached(cache, key, submission_file, metrics):
+        return None
+    metrics.count('subprocesses')
+    captures = [OutputCapture(head_limit, tail_limit, '%s.stdout' % log if log else None),
+                OutputCapture(head_limit, tail_limit, '%s.stderr' % log if log else None)]
+    try:
+        args = limits.wrap([command] + parameters) if limits is not None else [command] + parameters
+        with metrics.phase('test'), Popen(args, stdout=PIPE, stderr=PIPE, cwd=cwd, start_new_session=True) as process:
+            start = monotonic()
+            readers = [Thread(target=capture.read_from, args=(stream.fileno(),), daemon=True)
+                       for capture, stream in zip(captures, (process.stdout, process.stderr))]
+            for reader in readers:
+                reader.start()
+            waiter = _Waiter(process)
+            waiter.start()
+            try:
+                waiter.join(timeout)
+                timed_out = waiter.is_alive()
+            finally:
+                # Also stops any processes that the test left running in the background
+                _kill_group(process)
+            waiter.join()
+            # The output is only complete once both streams are closed. The readers are given
+            # at least a second, so that a test that exits just before the timeout is not lost
+            for reader in readers:
+                reader.join(max(start + timeout - monotonic(), 1))
+                timed_out = timed_out or reader.is_alive()
+    finally:
+        for capture in captures:
+            capture.stop()
+            capture.close()
+    usage = {'returncode': process.returncode,
+             'wall': monotonic() - start,
+             'cpu': waiter.rusage.ru_utime + waiter.rusage.ru_stime,
+             'memory': waiter.rusage.ru_maxrss * 1024,
+             'timed_out': timed_out}
+    metrics.record('test cpu', usage['cpu'])
+    if timed_out:
+        metrics.count('timeouts')
+        # A timeout can be caused by the load on the machine, so it is not cached
+        score_test(submission_file, None, None, 'Test failed due to timeout')
+        return usage
+    stdout = captures[0].text()
+    stderr = captures[1].text()
+    breach = limits.breach(process.returncode, stderr, usage['cpu']) if limits is not None else None
+    if breach is not None:
+        metrics.count('limit breaches')
+        stderr = '%s\n%s' % (breach, stderr) if stderr else breach
+    score_test(submission_file, process.returncode, stdout, stderr, cache=cache, key=key)
+    return usage
+
+
+class _Waiter(Thread):
+    """Waits for a test process to exit, collecting its resource usage."""
+
+    def __init__(self, process):
+        Thread.__init__(self, daemon=True)
+        self.process = process
+        self.rusage = None
+
+    def run(self):
+        _, status, self.rusage = os.wait4(self.process.pid, 0)
+        # Setting the return code stops the Popen from waiting for the reaped process itself
+        self.process.returncode = os.waitstatus_to_exitcode(status)
+
+
+def _kill_group(process):
+    """Kill all processes in the ``process``'s process group."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def score_test(submission_file, returncode, stdout, stderr, cache=None, key=None):
+    """Set the score and feedback of the ``submission_file`` from the result of a test
+    run. A test that exits with ``returncode`` 0 scores 2 and only its ``stdout`` is
+    added to the feedback. Any other test scores 1 and both its ``stdout`` and ``stderr``
+    are added to the feedback.
+
+    :param submission_file: The :class:`~automarking.core.SubmissionPart` that was tested
+    :param returncode: The test's return code or ``None`` if it did not complete
+    :type returncode: ``int``
+    :param stdout: The test's standard output
+    :type stdout: ``unicode``
+    :param stderr: The test's standard error
+    :type stderr: ``unicode``
+    :param cache: The cache to store the score and feedback in
+    :type cache: :class:`~automarking.cache.ResultCache`
+    :param key: The key to store the score and feedback under
+    :type key: ``unicode``
+    """
+    feedback_start = len(submission_file.feedback)
+    if returncode == 0:
+        submission_file.score = 2
+        if stdout:
+            submission_file.feedback.append(stdout)
+    else:
+        submission_file.score = 1
+        if stdout:
+            submission_file.feedback.append(stdout)
+        if stderr:
+            submission_file.feedback.append(stderr)
+    if cache is not None:
+        cache.put(key, submission_file.score, submission_file.feedback[feedback_start:])
+
+
+def _apply_cached(cache, key, submission_file, metrics):
+    """Apply the result cached under the ``key`` to the ``submission_file``.
+
+    :return: ``True`` if a cached result was applied, ``False`` otherwise
+    :rtype: ``boolean``
+    """
+    if cache is None:
+        return False
+    result = cache.get(key)
+    if result is None:
+        metrics.count('cache misses')
+        return False
+    metrics.count('cache hits')
+    submission_file.score = result[0]
+    submission_file.feedback.extend(result[1])
+    return True
+
+
+class OutputCapture(object):
+    """Captures an output stream, keeping only the first ``head_limit`` and the last
+    ``tail_limit`` bytes in memory. The start of the output is decoded incrementally
+    as it arrives, the end once the output is complete. Invalid UTF-8 is replaced
+    rather than failing the test.
+
+    :param head_limit: The number of bytes to keep from the start of the output
+    :type head_limit: ``int``
+    :param tail_limit: The number of bytes to keep from the end of the output
+    :type tail_limit: ``int``
+    :param log: The name of a file to write the complete output to
+    :type log: ``unicode``
+    """
+
+    def __init__(self, head_limit=HEAD_LIMIT, tail_limit=TAIL_LIMIT, log=None):
+        self.head_limit = head_limit
+        self.tail_limit = tail_limit
+        self.size = 0
+        self.head = []
+        self.tail = bytearray()
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.log = open(log, 'wb') if log else None
+        self.stopped = False
+
+    def write(self, data):
+        """Add the next chunk of ``data`` to the output."""
+        if self.log is not None:
+            self.log.write(data)
+        head_size = min(max(self.head_limit - self.size, 0), len(data))
+        self.size = self.size + len(data)
+        if head_size > 0:
+            self.head.append(self.decoder.decode(data[:head_size]))
+        if head_size < len(data) and self.tail_limit > 0:
+            # Deleting from the front of a bytearray does not move the remaining bytes,
+            # so this acts as a ring buffer over the last tail_limit bytes
+            self.tail.extend(data[head_size:])
+            if len(self.tail) > self.tail_limit:
+                del self.tail[:len(self.tail) - self.tail_limit]
+
+    def read_from(self, fd):
+        """Read the output from the file descriptor ``fd`` until it is closed or the
+        capture is stopped."""
+        while not self.stopped:
+            try:
+                data = os.read(fd, 65536)
+            except OSError:
+                # The stream was closed after the test was killed
+                break
+            if not data:
+                break
+            self.write(data)
+
+    def stop(self):
+        """Stop reading the output."""
+        self.stopped = True
+
+    def text(self):
+        """Return the captured output. If any output was dropped, a marker with the
+        number of dropped bytes separates the start from the end.
+
+        :rtype: ``unicode``
+        """
+        # The head's decoder is copied, so that the text can be generated more than once
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        decoder.setstate(self.decoder.getstate())
+        text = ''.join(self.head)
+        omitted = self.size - self.head_limit - len(self.tail)
+        if omitted <= 0:
+            # The tail continues the head, including any character split between them
+            return text + decoder.decode(bytes(self.tail), final=True)
+        text = text + decoder.decode(b'', final=True) + '\n[... %i bytes omitted ...]\n' % omitted
+        tail = self.tail
+        skip = 0
+        # Skip the continuation bytes of a character that was cut off at the start
+        while skip < min(3, len(tail)) and tail[skip] & 0xc0 == 0x80:
+            skip = skip + 1
+        return text + tail[skip:].decode('utf-8', 'replace')
+
+    def close(self):
+        """Close the log file, if there is one."""
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+def run_tests(jobs, concurrency=4, timeout=60, cache=None, metrics=None,
+              head_limit=HEAD_LIMIT, tail_limit=TAIL_LIMIT, limits=None, history=None, progress=None):
+    """Run many tests concurrently, scoring each in the same way as :func:`~automarking.tests.run_test`.
+    At most ``concurrency`` tests run at the same time and each test that runs for longer than
+    ``timeout`` seconds is killed, without holding up the remaining tests.
+
+    If a :class:`~automarking.history.RuntimeHistory` is given, the tests are started in the
+    order of their estimated runtime, longest first, so that no long test is left to run on
+    its own at the end. Tests without an estimate are assumed to take the average time of
+    the others. The runtime of each test is recorded in and saved to the history.
+
+    As the scores are set when the tests complete, the tests must be run before the
+    :class:`~automarking.core.Submission`\ s that the :class:`~automarking.core.SubmissionPart`\ s
+    belong to are completed::
+
+        with source as submissions:
+            submissions = list(submissions)
+            run_tests([('java', ['-jar', 'test.jar', part.data[0]], part)
+                       for submission in submissions for part in submission.parts])
+            for submission in submissions:
+                with submission as parts:
+                    for part in parts:
+                        with part:
+                            pass
+
+    :param jobs: The tests to run as (command, parameters, submission_file) tuples
+    :type jobs: ``list`` of ``tuple``
+    :param concurrency: The maximum number of tests to run at the same time
+    :type concurrency: ``int``
+    :param timeout: The timeout for each test in seconds
+    :type timeout: ``int``
+    :param cache: The cache to look up and store results in. Only the tests without
+                  a cached result are run.
+    :type cache: :class:`~automarking.cache.ResultCache`
+    :param metrics: The metrics to record the test runs in
+    :type metrics: :class:`~automarking.metrics.Metrics`
+    :param head_limit: The number of bytes to keep from the start of each output stream
+    :type head_limit: ``int``
+    :param tail_limit: The number of bytes to keep from the end of each output stream
+    :type tail_limit: ``int``
+    :param limits: The resource limits to run each test under
+    :type limits: :class:`~automarking.tests.Limits`
+    :param history: The history to estimate the order of the tests from and to record
+                    their runtimes in
+    :type history: :class:`~automarking.history.RuntimeHistory`
+    :param progress: Called with the number of completed tests, the total number of tests,
+                     and the estimated number of seconds until all tests are completed,
+                     each time a test completes
+    :type progress: ``callable``
+    :return: The resource usage of each test, as returned by :func:`~automarking.tests.run_test`
+    :rtype: ``list`` of ``dict``
+    """
+    return asyncio.run(run_tests_async(jobs, concurrency=concurrency, timeout=timeout, cache=cache,
+                                       metrics=metrics, head_limit=head_limit, tail_limit=tail_limit,
+                                       limits=limits, history=history, progress=progress))
+
+
+async def run_tests_async(jobs, concurrency=4, timeout=60, cache=None, metrics=None,
+                          head_limit=HEAD_LIMIT, tail_limit=TAIL_LIMIT, limits=None, history=None, progress=None):
+    """Coroutine version of :func:`~automarking.tests.run_tests` for use in an already
+    running event loop. The tests are run with :func:`~automarking.tests.run_test` on a
+    pool of ``concurrency`` threads."""
+    metrics = metrics if metrics is not None else NullMetrics()
+    loop = asyncio.get_running_loop()
+    estimates = _estimate_runtimes(jobs, history)
+    order = list(range(len(jobs)))
+    if history is not None:
+        order.sort(key=lambda index: estimates[index], reverse=True)
+    remaining_work = sum(estimates)
+    completed_work = 0
+    runtime = 0
+    done = 0
+
+    async def run_job(index):
+        nonlocal remaining_work, completed_work, runtime, done
+        command, parameters, submission_file = jobs[index]
+        usage = await loop.run_in_executor(executor, _run_test_job, command, parameters, submission_file, timeout,
+                                           cache, metrics, head_limit, tail_limit, limits)
+        if usage is not None:
+            runtime = runtime + usage['wall']
+            if history is not None:
+                history.record(command, submission_file, usage['wall'])
+        remaining_work = remaining_work - estimates[index]
+        completed_work = completed_work + estimates[index]
+        done = done + 1
+        if progress is not None:
+            # The estimates are scaled by how long the completed tests actually took
+            if done == len(jobs):
+                eta = 0
+            elif completed_work > 0:
+                eta = remaining_work * runtime / completed_work / min(concurrency, len(jobs) - done)
+            else:
+                eta = None
+            progress(done, len(jobs), eta)
+        return usage
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # The tests are started in the order that their tasks are created in
+        usages = await asyncio.gather(*[run_job(index) for index in order])
+    if history is not None:
+        history.save()
+    results = [None] * len(jobs)
+    for index, usage in zip(order, usages):
+        results[index] = usage
+    return results
+
+
+def _estimate_runtimes(jobs, history):
+    """Estimate the runtime of each of the ``jobs`` from the ``history``. If there is
+    no estimate for any of the jobs, the size of their files is used instead, which at
+    least orders them by the amount of work. Without a ``history`` each job counts the
+    same.
+
+    :rtype: ``list`` of ``float``
+    """
+    if history is None:
+        return [1] * len(jobs)
+    estimates = [history.estimate(command, submission_file) for command, _, submission_file in jobs]
+    known = [estimate for estimate in estimates if estimate is not None]
+    if not known:
+        return [data_size(submission_file) for _, _, submission_file in jobs]
+    average = sum(known) / len(known)
+    return [estimate if estimate is not None else average for estimate in estimates]
+
+
+def _run_test_job(command, parameters, submission_file, timeout, cache, metrics, head_limit, tail_limit, limits):
+    return run_test(command, parameters, submission_file, timeout=timeout, cache=cache, metrics=metrics,
+                    head_limit=head_limit, tail_limit=tail_limit, limits=limits)